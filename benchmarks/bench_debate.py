@@ -0,0 +1,225 @@
+import os
+import sys
+import csv
+import math
+import time
+import argparse
+import tracemalloc
+import contextlib
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from mad_framework import team
+from stub_backend import install
+
+
+# Times the debate engine on a stub model, so that only orchestration
+# (prompt construction, bookkeeping, batching, belief parsing) is measured.
+#
+#   python benchmarks/bench_debate.py --agents 2 4 8 --rounds 1 2 4 8
+#
+# Every case reports CPU time per turn, peak traced memory and retained
+# blocks, and the exponent of the total CPU time over the number of rounds
+# (about 1 is linear, 2 is quadratic).
+
+SYSTEM_TEXT = "Engage in an active debate to determine the correct answer. Answer: <A/B/C/D>; Confidence: <NN%>"
+TASK_PROMPT = "Question: Which choice is correct?\nChoices:\nA: one\nB: two\nC: three\nD: four\nLet's think step by step."
+BELIEFS = [("The answer is A", 3), ("The answer is B", 2), ("The question is ambiguous", 1)]
+
+
+def make_team(num_agents, beliefs=False, **kwargs):
+    agents = [
+        team.Agent(name=f"Agent {k+1}", persona="", beliefs=list(BELIEFS) if beliefs else [], model="stub")
+        for k in range(num_agents)
+    ]
+    return team.Team(agents, list(range(num_agents)), **kwargs)
+
+
+def case_prompt(num_agents, rounds):
+    """Agent.build_messages for every turn of a discussion."""
+    team_instance = make_team(num_agents)
+    text = "word " * 64
+
+    def run():
+        agent_log = {agent.name: [] for agent in team_instance.agents}
+        message_log = {}
+        for r in range(rounds):
+            for agent in team_instance.agents:
+                agent.build_messages(SYSTEM_TEXT, TASK_PROMPT, agent_log, message_log)
+                agent_log[agent.name].append(f"{agent.name}: {text}")
+    return run, num_agents * rounds
+
+
+def case_kickoff(num_agents, rounds):
+    """Team.kickoff of one discussion."""
+    def run():
+        make_team(num_agents).kickoff(SYSTEM_TEXT, TASK_PROMPT, rounds=rounds)
+    return run, num_agents * rounds
+
+
+def case_eval(num_agents, rounds, eval_mode="per_belief"):
+    """Team.evaluate of every agent's beliefs after the whole discussion."""
+    team_instance = make_team(num_agents, beliefs=True, strategy="belief", eval_mode=eval_mode)
+    discussion = [f"Agent {t % num_agents + 1}: " + "word " * 64 for t in range(num_agents * rounds)]
+
+    def run():
+        team_instance.evaluate(discussion)
+    return run, num_agents * rounds
+
+
+def case_eval_joint(num_agents, rounds):
+    return case_eval(num_agents, rounds, eval_mode="joint")
+
+
+def case_runner(num_agents, rounds, debates=8):
+    """team.run_debates over several discussions, as in the runner scripts."""
+    def run():
+        finished = []
+        team.run_debates(
+            ((j, make_team(num_agents).start(SYSTEM_TEXT, TASK_PROMPT, rounds=rounds)) for j in range(debates)),
+            lambda key, result: finished.append(key),
+            max_in_flight=debates,
+        )
+    return run, num_agents * rounds * debates
+
+
+CASES = {
+    "prompt": case_prompt,
+    "kickoff": case_kickoff,
+    "eval": case_eval,
+    "eval_joint": case_eval_joint,
+    "runner": case_runner,
+}
+
+
+def measure(case, num_agents, rounds, repeat):
+    """
+    :return: dict with the best CPU time per turn over `repeat` runs, and the
+        peak memory and retained (allocated, not freed) blocks of one traced run.
+    """
+    run, turns = case(num_agents, rounds)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        run()  # warm-up
+        cpu = []
+        for _ in range(repeat):
+            start = time.process_time()
+            run()
+            cpu.append(time.process_time() - start)
+
+        tracemalloc.start()
+        before = sum(stat.count for stat in tracemalloc.take_snapshot().statistics("filename"))
+        run()
+        blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics("filename")) - before
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return {"turns": turns, "cpu_total": min(cpu), "cpu_per_turn": min(cpu) / turns,
+            "peak_bytes": peak, "retained_blocks": blocks}
+
+
+def exponent(rows):
+    """Least-squares slope of log(cpu_total) over log(rounds)."""
+    points = [(math.log(row["rounds"]), math.log(row["cpu_total"])) for row in rows if row["cpu_total"] > 0]
+    if len(points) < 2:
+        return float("nan")
+    mean_x = sum(x for x, y in points) / len(points)
+    mean_y = sum(y for x, y in points) / len(points)
+    spread = sum((x - mean_x) ** 2 for x, y in points)
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / spread if spread else float("nan")
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+
+    argparser.add_argument(
+        "--cases",
+        type=str,
+        nargs="+",
+        choices=list(CASES),
+        default=list(CASES),
+        help="Benchmarks to run.",
+    )
+
+    argparser.add_argument(
+        "--agents",
+        type=int,
+        nargs="+",
+        default=[2, 4, 8],
+        help="Numbers of agents.",
+    )
+
+    argparser.add_argument(
+        "--rounds",
+        type=int,
+        nargs="+",
+        default=[1, 2, 4, 8],
+        help="Numbers of rounds.",
+    )
+
+    argparser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="Timed runs per point; the fastest one is reported.",
+    )
+
+    argparser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="Seconds every stub model call takes.",
+    )
+
+    argparser.add_argument(
+        "--output_words",
+        type=int,
+        default=64,
+        help="Words in every stub response.",
+    )
+
+    argparser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="Also write every point to this CSV file.",
+    )
+
+    argparser.add_argument(
+        "--max_exponent",
+        type=float,
+        default=None,
+        help="Exit with an error if the CPU time of a case grows faster than rounds**max_exponent.",
+    )
+
+    args = argparser.parse_args()
+
+    install("stub", latency=args.latency, output_words=args.output_words)
+
+    rows = []
+    failed = []
+    print(f"{'case':<11} {'agents':>6} {'rounds':>6} {'turns':>6} {'cpu/turn ms':>12} {'peak KB':>9} {'retained':>8}")
+    for name in args.cases:
+        for num_agents in args.agents:
+            curve = []
+            for rounds in args.rounds:
+                row = {"case": name, "agents": num_agents, "rounds": rounds}
+                row.update(measure(CASES[name], num_agents, rounds, args.repeat))
+                curve.append(row)
+                print(f"{name:<11} {num_agents:>6} {rounds:>6} {row['turns']:>6} {row['cpu_per_turn'] * 1e3:>12.3f} "
+                      f"{row['peak_bytes'] / 1024:>9.1f} {row['retained_blocks']:>8}")
+            slope = exponent(curve)
+            print(f"{name:<11} {num_agents:>6} {'':>6} scaling exponent over rounds: {slope:.2f}")
+            for row in curve:
+                row["exponent"] = slope
+            if args.max_exponent is not None and slope > args.max_exponent:
+                failed.append((name, num_agents, slope))
+            rows.extend(curve)
+
+    if args.output:
+        with open(args.output, "w", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+
+    if failed:
+        for name, num_agents, slope in failed:
+            print(f"{name} with {num_agents} agents scales as rounds**{slope:.2f}")
+        sys.exit(1)
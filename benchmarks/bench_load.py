@@ -0,0 +1,139 @@
+import os
+import sys
+import csv
+import time
+import argparse
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import torch
+from mad_framework import huggingface_lib
+
+
+# Loads a Hugging Face model with every load profile and measures it:
+#
+#   python benchmarks/bench_load.py --model Qwen/Qwen2.5-0.5B-Instruct --profiles cpu cpu_int8 --threads 8
+#
+# Every profile reports the load time, the first generate call (which
+# includes any torch.compile warm-up), the steady-state decode speed in
+# tokens/sec and the memory footprint of the weights. Profiles that need a
+# GPU are skipped on CPU-only machines.
+
+PROMPT = [{"role": "user", "content": "Explain in a few sentences why the sky is blue."}]
+
+
+def unload(model_name):
+    # also collects garbage and empties the CUDA cache
+    huggingface_lib._model_cache.free(model_name, force=True)
+
+
+def generate(tokenizer, model, inputs, new_tokens):
+    """Greedy decoding of exactly new_tokens tokens; returns the seconds it took."""
+    start = time.perf_counter()
+    with torch.inference_mode():
+        model.generate(
+            **inputs,
+            pad_token_id=huggingface_lib._pad_token_id(tokenizer),
+            do_sample=False,
+            max_new_tokens=new_tokens,
+            min_new_tokens=new_tokens,
+        )
+    return time.perf_counter() - start
+
+
+def measure(model_name, profile, new_tokens, repeat):
+    unload(model_name)
+    start = time.perf_counter()
+    tokenizer, model = huggingface_lib.load_model(model_name, profile)
+    load_time = time.perf_counter() - start
+
+    text = tokenizer.apply_chat_template(PROMPT, tokenize=False, add_generation_prompt=True)
+    inputs = tokenizer(text, return_tensors="pt").to(model.device)
+    first_call = generate(tokenizer, model, inputs, new_tokens)
+    steady = min(generate(tokenizer, model, inputs, new_tokens) for _ in range(repeat))
+
+    footprint = huggingface_lib.footprint((tokenizer, model))
+    unload(model_name)
+    return {"load_time": load_time, "first_call": first_call, "tokens_per_sec": new_tokens / steady,
+            "footprint_mb": footprint / 1024**2}
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+
+    argparser.add_argument(
+        "--model",
+        type=str,
+        default="meta-llama/Llama-3.2-1B-Instruct",
+        help="Hugging Face model name.",
+    )
+
+    argparser.add_argument(
+        "--profiles",
+        type=str,
+        nargs="+",
+        choices=list(huggingface_lib.LOAD_PROFILES),
+        default=list(huggingface_lib.LOAD_PROFILES),
+        help="Load profiles to compare.",
+    )
+
+    argparser.add_argument(
+        "--threads",
+        type=int,
+        default=None,
+        help="Torch threads, overrides the profiles' setting.",
+    )
+
+    argparser.add_argument(
+        "--compile",
+        action="store_true",
+        help="Also run every profile with torch.compile.",
+    )
+
+    argparser.add_argument(
+        "--new_tokens",
+        type=int,
+        default=64,
+        help="Tokens decoded by every timed call.",
+    )
+
+    argparser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="Timed calls after the first one; the fastest one is reported.",
+    )
+
+    argparser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="Also write every profile to this CSV file.",
+    )
+
+    args = argparser.parse_args()
+
+    variants = []
+    for name in args.profiles:
+        for compiled in ([False, True] if args.compile else [False]):
+            profile = {"base": name, "compile": compiled}
+            if args.threads is not None:
+                profile["threads"] = args.threads
+            variants.append((name + ("+compile" if compiled else ""), profile))
+
+    rows = []
+    print(f"{'profile':<18} {'load s':>8} {'first call s':>13} {'tokens/sec':>11} {'weights MB':>11}")
+    for label, profile in variants:
+        settings = huggingface_lib.resolve_profile(profile)
+        if settings["device_map"] != "cpu" and not torch.cuda.is_available():
+            print(f"{label:<18} skipped, needs a GPU")
+            continue
+        row = {"profile": label, "model": args.model, "threads": settings["threads"] or torch.get_num_threads()}
+        row.update(measure(args.model, profile, args.new_tokens, args.repeat))
+        rows.append(row)
+        print(f"{label:<18} {row['load_time']:>8.2f} {row['first_call']:>13.2f} {row['tokens_per_sec']:>11.1f} "
+              f"{row['footprint_mb']:>11.1f}")
+
+    if args.output and rows:
+        with open(args.output, "w", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
@@ -0,0 +1,54 @@
+import asyncio
+import json
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from mad_framework.backends import Backend, register_backend
+
+
+class StubBackend(Backend):
+    """
+    Deterministic stand-in for a model: every response has the same number of
+    words and ends with a verdict line, after a fixed latency. Belief
+    evaluations return valid JSON that keeps every strength. It lets the
+    benchmarks time the debate engine without any model work.
+    """
+    name = "stub"
+
+    def __init__(self, model="stub", latency=0.0, output_words=64, max_concurrency=64):
+        """
+        :param latency: Seconds every call takes.
+        :param output_words: Number of words of every response.
+        """
+        super().__init__(model, max_concurrency=max_concurrency)
+        self.latency = latency
+        self.text = " ".join(["word"] * output_words) + "\nAnswer: A; Confidence: 80%"
+        self.calls = 0
+
+    async def chat(self, messages, response_format=None, stop_sequences=None):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        prompt_token = sum(len(message["content"].split()) for message in messages)
+        return self.text, {"prompt_token": prompt_token, "generated_token": len(self.text.split())}
+
+    async def evaluate(self, messages_list, response_format, values_list=None):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if values_list is None:
+            values_list = [None] * len(messages_list)
+        answers = []
+        for values in values_list:
+            if values and "beliefs" in values:
+                answers.append(json.dumps({"beliefs": [dict(belief, updated_strength=3) for belief in values["beliefs"]]}))
+            else:
+                answers.append(json.dumps({"belief": (values or {}).get("belief", ""), "updated_strength": 3}))
+        return answers
+
+
+def install(model="stub", **kwargs):
+    """Registers a StubBackend for the model name and returns it."""
+    backend = StubBackend(model, **kwargs)
+    register_backend(model, backend)
+    return backend
@@ -0,0 +1,121 @@
+import os
+import argparse
+
+
+# Snapshots of the sampled questions with their prompts already rendered.
+# Once a snapshot exists the runners start without downloading or converting
+# the full dataset, and work offline.
+DATA_FOLDER = os.path.join(os.path.dirname(__file__), "data")
+
+prompting_method = "Let's think step by step."
+
+
+def render_mmlu(sample):
+    letters = ["A", "B", "C", "D"]
+    choices_formatted = "\n".join(f"{letters[i]}: {choice}" for i, choice in enumerate(sample['choices']))
+    subject = sample['subject'].replace("_", " ")
+    return {
+        "question": sample['question'],
+        "subject": sample['subject'],
+        "choices": list(sample['choices']),
+        "answer": sample['answer'],
+        "correct_answer": letters[sample['answer']],
+        "user_text": f"""Subject: {subject}\nQuestion: {sample['question']}\nChoices:\n{choices_formatted}\n{prompting_method}""",
+    }
+
+
+def render_strategyqa(sample):
+    return {
+        "question": sample['question'],
+        "answer": bool(sample['answer']),
+        "correct_answer": "Yes" if sample['answer'] else "No",
+        "user_text": f"""Question: {sample['question']}\n{prompting_method}""",
+    }
+
+
+# name: (load_dataset arguments, split, render function)
+DATASETS = {
+    "mmlu": (("cais/mmlu", "all"), "test", render_mmlu),
+    # Check the correct dataset link. This is actually train set!
+    "strategyqa": (("ChilleD/StrategyQA",), "test", render_strategyqa),
+}
+
+
+def snapshot_path(name, sample_size=100, random_seed=42, folder=DATA_FOLDER):
+    return os.path.join(folder, f"{name}_sample_{sample_size}_seed_{random_seed}.parquet")
+
+
+def prepare(name, sample_size=100, random_seed=42, folder=DATA_FOLDER):
+    """
+    Draws the seeded sample of a dataset and writes it, with rendered prompts,
+    to a Parquet snapshot. The rows are the ones
+    pd.DataFrame(split).sample(n=sample_size, random_state=random_seed) picks,
+    but only those rows are converted.
+
+    :return: The path of the snapshot.
+    """
+    import pandas as pd
+    from datasets import load_dataset
+
+    load_args, split, render = DATASETS[name]
+    data = load_dataset(*load_args)[split]
+    rows = pd.Series(range(len(data))).sample(n=sample_size, random_state=random_seed).tolist()
+
+    records = []
+    for row, sample in zip(rows, data.select(rows)):
+        record = {"row": row}
+        record.update(render(sample))
+        records.append(record)
+
+    path = snapshot_path(name, sample_size, random_seed, folder)
+    os.makedirs(folder, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    pd.DataFrame(records).to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+    return path
+
+
+def load_sample(name, sample_size=100, random_seed=42, folder=DATA_FOLDER):
+    """
+    Returns the sampled questions of a dataset as a DataFrame, memory-mapping
+    the snapshot and preparing it first if it does not exist yet.
+    """
+    # imported here, so that the runners parse their arguments without loading pandas
+    import pandas as pd
+
+    path = snapshot_path(name, sample_size, random_seed, folder)
+    if not os.path.exists(path):
+        print(f"Preparing {path}")
+        prepare(name, sample_size, random_seed, folder)
+    return pd.read_parquet(path, memory_map=True)
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+
+    argparser.add_argument(
+        "--dataset",
+        type=str,
+        nargs="+",
+        default=list(DATASETS),
+        help="Datasets to snapshot.",
+    )
+
+    argparser.add_argument(
+        "--sample_size",
+        type=int,
+        default=100,
+        help="Number of sampled questions.",
+    )
+
+    argparser.add_argument(
+        "--seed",
+        type=int,
+        default=42,
+        help="Random seed of the sample.",
+    )
+
+    args = argparser.parse_args()
+
+    for name in args.dataset:
+        print(prepare(name, args.sample_size, args.seed))
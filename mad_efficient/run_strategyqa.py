@@ -1,11 +1,13 @@
 import sys
 import os
 import argparse
-import pandas as pd
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from mad_framework import team
-from datasets import load_dataset
-import json
+from mad_framework import team, cache, results, metrics, registry
+from mad_framework.backends import resolve_backend, warm_up
+from mad_framework.context import ContextPolicy
+from mad_framework.const import verdict_stop_pattern
+from mad_efficient.runner_utils import atomic_write_json, RunProgress, parse_shard, launch_shards, check_coverage
+from mad_efficient.prepare_data import load_sample
 
 
 
@@ -15,7 +17,36 @@ argparser.add_argument(
     "--model",
     type=str,
     default="meta-llama/Llama-3.2-1B-Instruct",
-    help="Model name. Can be any ollama model.",
+    help="Model name. A Hugging Face model, an ollama model (name:tag) or an OpenAI model (gpt-...).",
+)
+
+argparser.add_argument(
+    "--draft_model",
+    type=str,
+    default=None,
+    help="Small Hugging Face model of the same family that drafts tokens for assisted decoding.",
+)
+
+argparser.add_argument(
+    "--load_profile",
+    type=str,
+    default=None,
+    help="How Hugging Face models are loaded: gpu_4bit, gpu_bf16, cpu, cpu_bf16 or cpu_int8. "
+         "Default: gpu_4bit with CUDA, else cpu.",
+)
+
+argparser.add_argument(
+    "--threads",
+    type=int,
+    default=None,
+    help="Torch threads for CPU inference of Hugging Face models.",
+)
+
+argparser.add_argument(
+    "--model_memory_mb",
+    type=int,
+    default=None,
+    help="Memory budget of the loaded Hugging Face models; models no agent uses are freed least recently used first.",
 )
 
 argparser.add_argument(
@@ -39,8 +70,149 @@ argparser.add_argument(
     help="Number of rounds in discussion.",
 )
 
+argparser.add_argument(
+    "--concurrency",
+    type=int,
+    default=1,
+    help="Number of debates kept in flight at once. Their turns are batched together.",
+)
+
+argparser.add_argument(
+    "--kv_cache",
+    action="store_true",
+    help="Keep each agent's key/value cache between rounds (Hugging Face models). Needs one "
+         "discussion at a time, spoken in turn (no --simultaneous, --concurrency 1).",
+)
+
+argparser.add_argument(
+    "--shared_first_round",
+    action="store_true",
+    help="Answer the first round simultaneously from one shared prompt (one prefill per model).",
+)
+
+argparser.add_argument(
+    "--simultaneous",
+    action="store_true",
+    help="Let every agent answer round r seeing only earlier rounds, so each round is generated in one batch.",
+)
+
+argparser.add_argument(
+    "--stop_at_verdict",
+    action="store_true",
+    help="End each response once its 'Answer: ...; Confidence: NN%%' line is complete.",
+)
+
+argparser.add_argument(
+    "--stop_sequences",
+    type=str,
+    nargs="+",
+    default=None,
+    help="Literal strings that end each response, sent as the API's `stop` parameter (OpenAI, "
+         "Ollama); Hugging Face models stop decoding there too.",
+)
+
+argparser.add_argument(
+    "--consensus",
+    type=float,
+    default=None,
+    help="End a debate early once this fraction of the agents give the same answer, e.g. 1.0.",
+)
+
+argparser.add_argument(
+    "--consensus_confidence",
+    type=float,
+    default=0,
+    help="Minimum confidence (in %%) of the agreeing agents for --consensus to end a debate.",
+)
+
+argparser.add_argument(
+    "--context_tokens",
+    type=int,
+    default=None,
+    help="Token budget of every prompt; older turns are dropped or summarized (see --context_mode).",
+)
+
+argparser.add_argument(
+    "--context_mode",
+    type=str,
+    choices=["window", "truncate", "summary"],
+    default="truncate",
+    help="How prompts are kept short: the last --context_window exchanges, dropping the oldest turns, or a rolling summary.",
+)
+
+argparser.add_argument(
+    "--context_window",
+    type=int,
+    default=None,
+    help="Number of each agent's latest exchanges kept with --context_mode window.",
+)
+
+argparser.add_argument(
+    "--verbose",
+    action="store_true",
+    help="Print the rounds and the chat history of every turn.",
+)
+
+argparser.add_argument(
+    "--cache",
+    type=str,
+    default=None,
+    help="SQLite file of the response cache. Reruns with the same settings are served from it.",
+)
+
+argparser.add_argument(
+    "--cache_max_mb",
+    type=int,
+    default=1024,
+    help="Size budget of the response cache in MB; least recently used responses are evicted.",
+)
+
+argparser.add_argument(
+    "--metrics",
+    type=str,
+    default=None,
+    help="Write the stats of every model call to this CSV file, or their totals in Prometheus format if it ends in .prom.",
+)
+
+argparser.add_argument(
+    "--resume",
+    action="store_true",
+    help="Skip the questions whose discussion log is already complete, e.g. after an interrupted job.",
+)
+
+argparser.add_argument(
+    "--output",
+    type=str,
+    choices=["json", "jsonl", "jsonl.zst"],
+    default="json",
+    help="One JSON file per discussion, or all discussions of a run appended to one (zstd-compressed) JSONL file.",
+)
+
+argparser.add_argument(
+    "--shard",
+    type=str,
+    default=None,
+    help="Only run shard i/N of the questions, e.g. 0/4. Shards of a run share its results folder.",
+)
+
+argparser.add_argument(
+    "--workers",
+    type=int,
+    default=1,
+    help="Run the shards in this many local processes, then check that every question is covered once.",
+)
+
+argparser.add_argument(
+    "--merge",
+    action="store_true",
+    help="Only check that the --workers shards of every run together covered each question exactly once.",
+)
+
 
 args = argparser.parse_args()
+if args.kv_cache and (args.simultaneous or args.concurrency > 1):
+    # the key/value cache is only reused when a generate call holds a single conversation
+    argparser.error("--kv_cache cannot be combined with --simultaneous or --concurrency > 1")
 print(args)
 
 
@@ -48,15 +220,33 @@ model_filename = args.model
 if "/" or ":" in args.model:
     model_filename = args.model.replace("/", "_")
 
+if args.cache:
+    cache.enable(args.cache, max_bytes=args.cache_max_mb * 1024**2)
 
-# Check the correct dataset link. This is actually train set!
-random_seed = 42
-dataset = load_dataset("ChilleD/StrategyQA")
+if args.load_profile is not None or args.threads is not None:
+    load_profile = {"base": args.load_profile}
+    if args.threads is not None:
+        load_profile["threads"] = args.threads
+    from mad_framework import huggingface_lib
+    for model in [args.model, args.draft_model]:
+        if model is not None:
+            huggingface_lib.set_load_profile(resolve_backend(model)[1], load_profile)
+
+if args.model_memory_mb is not None:
+    registry.models.max_bytes = args.model_memory_mb * 1024**2
 
+if args.metrics:
+    recorder = metrics.MetricsRecorder()
+    metrics.add_hook(recorder)
 
+if not (args.merge or (args.workers > 1 and args.shard is None)):
+    # load the models in the background while the dataset is read
+    warm_up([args.model, args.draft_model])
+
+random_seed = 42
 sample_size = 100
-df = pd.DataFrame(dataset['test'])
-df = df.sample(n=sample_size, random_state=random_seed)
+# seeded sample with rendered prompts, from the snapshot made by prepare_data.py
+df = load_sample("strategyqa", sample_size=sample_size, random_seed=random_seed)
 
 
 system_text = f"""Engage in an active debate to determine the correct answer. Contribute your reasoning in no more than five sentences. \
@@ -67,21 +257,26 @@ Answer: <Yes/No>; Confidence: <NN%>"""
 
 mad_strategy = "standard"
 
-for i in range(args.run):
+def discussion_path(folder, i, j):
+    return f"{folder}/strategyqa_{mad_strategy}_{model_filename}_run_{i}_agents_{args.num_agents}_discussion_log_{j}.json"
 
-    folder = f"results/strategyqa_{mad_strategy}_{model_filename}_run_{i}_agents_{args.num_agents}"
-    os.makedirs(folder, exist_ok=True)
 
-    for j in range(len(df)):
+def make_context():
+    """A new ContextPolicy for one agent, or None if prompts are not limited."""
+    if args.context_tokens is None and args.context_window is None:
+        return None
+    return ContextPolicy(max_tokens=args.context_tokens, mode=args.context_mode, window=args.context_window)
 
-        sample = df.iloc[j]
-        question = sample['question']
-        answer = sample['answer'] # boolean
-        # correct_answer = "Yes" if sample['answer'] else "No"
 
+def make_debates(folder, i, progress):
+    """Yields ((j, discussion_file), Debate) for every unfinished question of run i in this shard."""
+    for j in progress.indices:
+        if progress.done(j):
+            continue
 
-        prompting_method = "Let's think step by step."
-        user_text = f"""Question: {question}\n{prompting_method}"""
+        sample = df.iloc[j]
+        user_text = sample['user_text']
+        answer = sample['answer'] # boolean
 
 
         # DEFINE AGENTS:
@@ -92,18 +287,107 @@ for i in range(args.run):
                     name=f"Agent {k+1}",
                     persona="",
                     beliefs=[],
-                    model=args.model
+                    model=args.model,
+                    kv_cache=args.kv_cache,
+                    stop_patterns=[verdict_stop_pattern] if args.stop_at_verdict else None,
+                    stop_sequences=args.stop_sequences,
+                    verbose=args.verbose,
+                    context=make_context(),
+                    draft_model=args.draft_model
                 )
             )
 
         # START THE DISCUSSION:
         speaking_pattern = list(range(args.num_agents))
         
-        team_instance = team.Team(participants, speaking_pattern, strategy=mad_strategy)
+        team_instance = team.Team(participants, speaking_pattern, strategy=mad_strategy, shared_first_round=args.shared_first_round,
+                                  consensus=args.consensus, consensus_confidence=args.consensus_confidence,
+                                  simultaneous=args.simultaneous, verbose=args.verbose)
 
-        discussion_file = f"{folder}/strategyqa_{mad_strategy}_{model_filename}_run_{i}_agents_{args.num_agents}_discussion_log_{j}.json"
-        # Runs the debate
-        discussion_log, belief_change_log = team_instance.kickoff(system_text, user_text, rounds=args.round)
-        
-        with open(discussion_file, "w") as file:
-            json.dump(discussion_log, file, indent=4)
+        discussion_file = discussion_path(folder, i, j)
+        yield (j, discussion_file), team_instance.start(system_text, user_text, rounds=args.round)
+
+
+def save_discussion(progress, sink, i, key, result):
+    j, discussion_file = key
+    discussion_log, belief_change_log = result
+    if sink is None:
+        atomic_write_json(discussion_file, discussion_log)
+        progress.mark(j)
+    else:
+        progress.mark(j, save=False)
+        # the manifest only lists discussions that the sink has flushed
+        if sink.write({"run": i, "question": j, "discussion": discussion_log}):
+            progress.save()
+
+
+def sink_path(folder, shard):
+    name = "discussion_logs" if shard is None else f"discussion_logs_shard_{shard[0]}_of_{shard[1]}"
+    return f"{folder}/{name}.{args.output}"
+
+
+def run_folder(i):
+    return f"results/strategyqa_{mad_strategy}_{model_filename}_run_{i}_agents_{args.num_agents}"
+
+
+def merge():
+    """Reports the questions of every run not covered exactly once by its shards."""
+    complete = True
+    for i in range(args.run):
+        folder = run_folder(i)
+        log_path = (lambda j: discussion_path(folder, i, j)) if args.output == "json" else None
+        missing, duplicated = check_coverage(folder, len(df), log_path, args.workers)
+        print(f"Run {i}: {len(df) - len(missing)}/{len(df)} questions covered, missing {missing}, duplicated {duplicated}")
+        complete = complete and not missing and not duplicated
+    return complete
+
+
+if args.merge or (args.workers > 1 and args.shard is None):
+    failed = not args.merge and any(launch_shards(__file__, sys.argv[1:], args.workers))
+    sys.exit(0 if merge() and not failed else 1)
+
+shard = parse_shard(args.shard) if args.shard else None
+
+for i in range(args.run):
+
+    folder = run_folder(i)
+    os.makedirs(folder, exist_ok=True)
+    # every run samples its own responses
+    cache.set_seed(f"{random_seed}_run_{i}")
+
+    progress = RunProgress(folder, len(df), resume=args.resume, shard=shard)
+    sink = None
+    if args.output != "json":
+        if not args.resume and os.path.exists(sink_path(folder, shard)):
+            os.remove(sink_path(folder, shard))
+        sink = results.JSONLSink(sink_path(folder, shard))
+    if args.resume:
+        if sink is None:
+            progress.scan(lambda j: discussion_path(folder, i, j))
+        else:
+            progress.completed.update(record["question"] for record in results.read_jsonl(sink.path))
+        print(f"Run {i}: {len(progress)}/{len(progress.indices)} questions already done")
+
+    # Runs the debates, keeping args.concurrency of them in flight
+    team.run_debates(make_debates(folder, i, progress),
+                     lambda key, result: save_discussion(progress, sink, i, key, result),
+                     max_in_flight=args.concurrency)
+
+    if sink is not None:
+        sink.close()
+        progress.save()
+
+if args.metrics:
+    metrics_path = args.metrics
+    if shard is not None:
+        # every shard process writes its own file
+        root, extension = os.path.splitext(args.metrics)
+        metrics_path = f"{root}_shard_{shard[0]}_of_{shard[1]}{extension}"
+    recorder.save(metrics_path)
+
+if args.cache:
+    print(cache.get_cache().stats())
+
+if args.verbose:
+    for entry in registry.models.report():
+        print(f"{entry['model']}: {entry['bytes'] / 1024**2:.0f} MB resident, used by {entry['refs']} agent(s)")
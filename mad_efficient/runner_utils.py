@@ -0,0 +1,143 @@
+import os
+import sys
+import glob
+import json
+import subprocess
+from collections import Counter
+
+
+def atomic_write_json(path, obj, indent=4):
+    """
+    Writes `obj` to a temporary file next to `path` and renames it into place,
+    so an interrupted write never leaves a truncated file behind.
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(obj, file, indent=indent)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+
+def is_complete(path):
+    """True if `path` holds a discussion log that parses."""
+    try:
+        with open(path) as file:
+            json.load(file)
+        return True
+    except (OSError, ValueError):
+        return False
+
+
+class RunProgress:
+    """
+    Manifest of the finished questions of one run folder, kept in progress.json.
+    It is rewritten atomically after every finished debate, so a killed job
+    can restart where it stopped.
+    """
+    def __init__(self, folder, total, resume=False, shard=None):
+        """
+        :param folder: The run folder.
+        :param total: Number of questions in the run.
+        :param resume: Keep the progress recorded by an earlier job. Otherwise
+            the run starts over and every question is generated again.
+        :param shard: (index, count) of the shard handled by this process, see
+            shard_indices. Every shard keeps its own manifest in the folder.
+        """
+        if shard is None:
+            self.path = os.path.join(folder, "progress.json")
+            self.indices = range(total)
+        else:
+            self.path = os.path.join(folder, f"progress_shard_{shard[0]}_of_{shard[1]}.json")
+            self.indices = shard_indices(total, *shard)
+        self.total = total
+        self.shard = shard
+        self.completed = set()
+        if os.path.exists(self.path):
+            if resume:
+                with open(self.path) as file:
+                    self.completed = set(json.load(file)["completed"])
+            else:
+                os.remove(self.path)
+
+    def scan(self, log_path):
+        """
+        Also counts as finished every question whose log already exists and
+        parses, e.g. from runs made before the manifest existed.
+
+        :param log_path: Function from question index to its discussion log path.
+        """
+        for j in self.indices:
+            if j not in self.completed and is_complete(log_path(j)):
+                self.completed.add(j)
+
+    def done(self, j):
+        return j in self.completed
+
+    def mark(self, j, save=True):
+        """
+        :param save: Rewrite the manifest now. Pass False while the result is
+            not on disk yet (e.g. buffered by a JSONLSink) and call save() later.
+        """
+        self.completed.add(j)
+        if save:
+            self.save()
+
+    def save(self):
+        atomic_write_json(self.path, {"total": self.total, "shard": self.shard, "completed": sorted(self.completed)}, indent=None)
+
+    def __len__(self):
+        return len(self.completed)
+
+
+def parse_shard(text):
+    """Parses "i/N" into (i, N), with 0 <= i < N."""
+    index, _, count = text.partition("/")
+    index, count = int(index), int(count)
+    if not 0 <= index < count:
+        raise ValueError(f"Invalid shard {text!r}, expected i/N with 0 <= i < N")
+    return index, count
+
+
+def shard_indices(total, index, count):
+    """Questions of shard `index` out of `count`. Every question is in exactly one shard."""
+    return range(index, total, count)
+
+
+def launch_shards(script, argv, workers):
+    """
+    Runs `workers` copies of a runner script at once, each with its own
+    --shard, and waits for all of them. Every worker loads the model itself.
+
+    :return: The exit codes of the workers. Workers that failed are reported.
+    """
+    processes = [
+        subprocess.Popen([sys.executable, script] + list(argv) + ["--workers", "1", "--shard", f"{k}/{workers}"])
+        for k in range(workers)
+    ]
+    codes = [process.wait() for process in processes]
+    for k, code in enumerate(codes):
+        if code != 0:
+            print(f"Shard {k}/{workers} exited with code {code}", file=sys.stderr)
+    return codes
+
+
+def check_coverage(folder, total, log_path, shards=1):
+    """
+    Checks that the shards of a run folder together finished every question
+    exactly once.
+
+    :param log_path: Function from question index to its discussion log path,
+        or None if the logs are in a JSONL file and only the manifests count.
+    :param shards: Number of shards N the run was split into. Only their
+        manifests count, not those left by a run with another N.
+    :return: (missing, duplicated) lists of question indices.
+    """
+    name = "progress.json" if shards == 1 else f"progress_shard_*_of_{shards}.json"
+    counts = Counter()
+    for path in glob.glob(os.path.join(folder, name)):
+        with open(path) as file:
+            counts.update(json.load(file)["completed"])
+    missing = [j for j in range(total) if counts[j] == 0 or (log_path and not is_complete(log_path(j)))]
+    duplicated = sorted(j for j, count in counts.items() if count > 1)
+    return missing, duplicated
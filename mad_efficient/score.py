@@ -0,0 +1,195 @@
+import os
+import re
+import sys
+import glob
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from mad_framework import results
+from mad_framework.const import verdict_pattern
+from mad_efficient.prepare_data import load_sample
+
+
+# results/<dataset>_<strategy>_<model>_run_<i>_agents_<n>/
+folder_pattern = re.compile(r"^(?P<dataset>[a-z]+)_(?P<config>.*)_run_(?P<run>\d+)_agents_(?P<agents>\d+)$")
+log_pattern = re.compile(r"_discussion_log_(\d+)\.json$")
+
+
+def _turn_rows(dataset, config, run, agents, question, discussion):
+    rows = []
+    for round_key, turns in discussion.items():
+        # other keys, e.g. "Consensus", are not turns
+        if not round_key.startswith("Round "):
+            continue
+        for agent, turn in turns.items():
+            rows.append((dataset, config, run, agents, question, int(round_key[6:]), agent,
+                         turn["output"], turn["prompt_token"], turn["generated_token"]))
+    return rows
+
+
+def load_folder(folder):
+    """
+    Reads every discussion of one run folder, from per-question JSON files or
+    JSONL sinks.
+
+    :return: A list of (dataset, config, run, agents, question, round, agent,
+        output, prompt_token, generated_token) tuples, one per turn.
+    """
+    match = folder_pattern.match(os.path.basename(os.path.normpath(folder)))
+    if match is None:
+        return []
+    dataset, config = match["dataset"], match["config"]
+    run, agents = int(match["run"]), int(match["agents"])
+
+    rows = []
+    for path in glob.glob(os.path.join(folder, "*_discussion_log_*.json")):
+        question = log_pattern.search(path)
+        if question is None:
+            continue
+        with open(path) as file:
+            rows.extend(_turn_rows(dataset, config, run, agents, int(question.group(1)), json.load(file)))
+    for path in glob.glob(os.path.join(folder, "discussion_logs*.jsonl*")):
+        for record in results.read_jsonl(path):
+            rows.extend(_turn_rows(dataset, config, run, agents, record["question"], record["discussion"]))
+    return rows
+
+
+def load_turns(root, workers=None):
+    """
+    Loads every turn of every run folder under `root` into one DataFrame,
+    reading the folders in parallel processes.
+
+    :param root: A results folder, or a folder of them (e.g. results/).
+    :param workers: Number of processes; defaults to the number of CPUs.
+    """
+    import pandas as pd
+
+    folders = [root] if folder_pattern.match(os.path.basename(os.path.normpath(root))) else \
+        sorted(path for path in glob.glob(os.path.join(root, "*")) if os.path.isdir(path))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        rows = [row for folder_rows in executor.map(load_folder, folders) for row in folder_rows]
+    return pd.DataFrame(rows, columns=["dataset", "config", "run", "agents", "question", "round", "agent",
+                                       "output", "prompt_token", "generated_token"])
+
+
+def extract_verdicts(turns):
+    """
+    Adds the answer (first word, lower case) and confidence of the last
+    verdict line of every output. Outputs without a verdict get NaN.
+    """
+    verdicts = turns["output"].str.extractall(verdict_pattern).groupby(level=0).last()
+    turns["answer"] = verdicts[0].str.extract(r"(\w+)", expand=False).str.lower().reindex(turns.index)
+    turns["confidence"] = verdicts[1].astype(float).reindex(turns.index)
+    return turns
+
+
+def ground_truth(dataset, sample_size=100, random_seed=42):
+    """The correct answer of every sampled question, in the form extract_verdicts gives."""
+    import numpy as np
+    import pandas as pd
+
+    sample = load_sample(dataset, sample_size=sample_size, random_seed=random_seed)
+    return pd.DataFrame({
+        "dataset": dataset,
+        "question": np.arange(len(sample)),
+        "correct_answer": sample["correct_answer"].str.lower().to_numpy(),
+    })
+
+
+def calibration_error(confidence, correct, bins=10):
+    """Expected calibration error of confidences in [0, 1]."""
+    import numpy as np
+    import pandas as pd
+
+    bin_ids = np.minimum((confidence * bins).astype(int), bins - 1)
+    frame = pd.DataFrame({"bin": bin_ids, "confidence": confidence, "correct": correct})
+    by_bin = frame.groupby("bin").agg(confidence=("confidence", "mean"), correct=("correct", "mean"), n=("correct", "size"))
+    return float((by_bin["n"] * (by_bin["confidence"] - by_bin["correct"]).abs()).sum() / len(frame)) if len(frame) else np.nan
+
+
+def score(turns, sample_size=100, random_seed=42):
+    """
+    Per configuration and round: accuracy of the single turns, accuracy of
+    the majority vote per question, calibration and token totals. The row
+    with round "final" uses the last round of every discussion, which differs
+    from the last round when discussions ended early on consensus.
+    """
+    import pandas as pd
+
+    turns = extract_verdicts(turns)
+    truth = pd.concat([ground_truth(dataset, sample_size, random_seed) for dataset in turns["dataset"].unique()])
+    turns = turns.merge(truth, on=["dataset", "question"], how="left")
+    turns["correct"] = (turns["answer"] == turns["correct_answer"]).astype(float)
+    turns["parsed"] = turns["answer"].notna()
+
+    keys = ["dataset", "config", "agents", "run", "question"]
+    last_round = turns.groupby(keys)["round"].transform("max")
+    final = turns[turns["round"] == last_round].assign(round="final")
+    turns = pd.concat([turns.assign(round=turns["round"].astype(str)), final], ignore_index=True)
+
+    group = ["dataset", "config", "agents", "round"]
+    summary = turns.groupby(group).agg(
+        turns=("correct", "size"),
+        accuracy=("correct", "mean"),
+        parsed=("parsed", "mean"),
+        mean_confidence=("confidence", "mean"),
+        prompt_token=("prompt_token", "sum"),
+        generated_token=("generated_token", "sum"),
+    )
+
+    # majority vote of the agents' answers per question and round; a tie for the
+    # most votes has no majority and counts as incorrect, and so does a question
+    # without any parsed answer, as its turns do for the accuracy
+    question = group + ["run", "question"]
+    votes = turns.dropna(subset=["answer"]).groupby(question + ["answer"]).size().rename("votes").reset_index()
+    tied = votes.groupby(question)["votes"].transform(lambda v: (v == v.max()).sum() > 1)
+    votes = votes.sort_values("votes", ascending=False, kind="stable").assign(tied=tied).drop_duplicates(question)
+    votes = votes.merge(truth, on=["dataset", "question"], how="left")
+    votes["majority_correct"] = (votes["answer"] == votes["correct_answer"]) & ~votes["tied"]
+    votes = turns[question].drop_duplicates().merge(votes[question + ["majority_correct"]], on=question, how="left")
+    majority_correct = votes["majority_correct"].fillna(False).astype(float)
+    summary["majority_accuracy"] = majority_correct.groupby([votes[c] for c in group]).mean()
+
+    rated = turns.dropna(subset=["confidence"])
+    confidence = (rated["confidence"].clip(0, 100) / 100)
+    rated = rated.assign(brier=(confidence - rated["correct"]) ** 2, confidence=confidence)
+    summary["brier"] = rated.groupby(group)["brier"].mean()
+    summary["ece"] = rated.groupby(group).apply(lambda g: calibration_error(g["confidence"].to_numpy(), g["correct"].to_numpy()))
+    return summary.reset_index()
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+
+    argparser.add_argument(
+        "root",
+        type=str,
+        nargs="?",
+        default="results",
+        help="A run folder, or a folder of run folders.",
+    )
+
+    argparser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of processes reading the results. Defaults to the number of CPUs.",
+    )
+
+    argparser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="Also write the summary to this CSV file.",
+    )
+
+    args = argparser.parse_args()
+    # pandas is imported after the arguments, so --help answers at once
+    import pandas as pd
+
+    summary = score(load_turns(args.root, workers=args.workers))
+    with pd.option_context("display.max_rows", None, "display.width", 200):
+        print(summary)
+    if args.output:
+        summary.to_csv(args.output, index=False)
@@ -0,0 +1,358 @@
+import re
+import asyncio
+import threading
+import concurrent.futures
+from . import registry
+
+# The backend libraries (transformers/torch, requests, openai) are imported
+# inside the backends that use them, so importing this module stays cheap.
+
+
+# ---- Event loop shared by all backends ----
+# Connection pools (the async OpenAI client, semaphores) are bound to the loop
+# they were created in, so every call goes through one long-lived loop.
+_loop = None
+_loop_lock = threading.Lock()
+
+def _get_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="mad-backends", daemon=True).start()
+    return _loop
+
+
+def run(coro):
+    """
+    Runs a backend coroutine from synchronous code and returns its result.
+    """
+    return asyncio.run_coroutine_threadsafe(coro, _get_loop()).result()
+
+
+class Backend:
+    """
+    Common interface of the model backends. Every backend answers a list of
+    conversations at once, so the caller does not need to know whether they
+    are batched (Hugging Face) or sent as concurrent requests (Ollama, OpenAI).
+
+    respond returns a list of (text, token_count) with
+    token_count = {"prompt_token": int, "generated_token": int}.
+    """
+    name = None
+    # whether load_draft is supported (assisted decoding)
+    supports_draft = False
+
+    def __init__(self, model, max_concurrency=8):
+        """
+        :param model: The model name, as given to the Agent.
+        :param max_concurrency: Maximum number of requests in flight for this model.
+        """
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self._semaphore = None
+
+    @property
+    def semaphore(self):
+        # created lazily inside the backend loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    async def respond(self, messages_list, caches=None, stop_patterns=None, stop_sequences=None, draft_model=None):
+        """
+        Generates one chat turn for every conversation.
+
+        :param messages_list: A list of chat histories.
+        :param caches: Optional per-conversation PrefixCache (Hugging Face only).
+        :param stop_patterns: Regular expressions that end a response once matched. Hugging Face
+            models stop decoding there; API responses are cut after the first match.
+        :param stop_sequences: Literal strings sent as the API's own `stop` parameter.
+        :param draft_model: Name of a draft model for assisted decoding (Hugging Face only,
+            see load_draft).
+        :return: A list of (text, token_count).
+        """
+        outputs = await asyncio.gather(*(self._limited(self.chat, messages, None, stop_sequences) for messages in messages_list))
+        return [(trim_at_stop(text, stop_patterns), token_count) for text, token_count in outputs]
+
+    async def sample(self, messages, n, stop_patterns=None, stop_sequences=None, draft_model=None):
+        """
+        Generates n independent responses to the same conversation.
+
+        :return: A list of (text, token_count).
+        """
+        outputs = await asyncio.gather(*(self._limited(self.chat, messages, None, stop_sequences) for _ in range(n)))
+        return [(trim_at_stop(text, stop_patterns), token_count) for text, token_count in outputs]
+
+    async def sample_batch(self, messages_list, n, stop_patterns=None, stop_sequences=None, draft_model=None):
+        """
+        Generates n independent responses to every conversation.
+
+        :return: One list of (text, token_count) per conversation.
+        """
+        return list(await asyncio.gather(*(self.sample(messages, n, stop_patterns, stop_sequences, draft_model)
+                                           for messages in messages_list)))
+
+    async def evaluate(self, messages_list, response_format, values_list=None):
+        """
+        Generates a JSON answer for every belief evaluation prompt.
+
+        :param messages_list: A list of chat histories.
+        :param response_format: The expected answer, e.g. const.belief_json_schema.
+        :param values_list: The fixed string values of each answer (see
+            huggingface_lib.json_template). Only used for constrained decoding.
+        :return: A list of raw model answers.
+        """
+        outputs = await asyncio.gather(*(self._limited(self.chat, messages, response_format) for messages in messages_list))
+        return [text for text, token_count in outputs]
+
+    async def chat(self, messages, response_format=None, stop_sequences=None):
+        raise NotImplementedError
+
+    def count_tokens(self, text):
+        """Estimated number of tokens of `text` (about 4 characters per token)."""
+        return len(text) // 4 + 1
+
+    def load_draft(self, draft_model):
+        """Loads a draft model for assisted decoding of this backend's model."""
+        raise ValueError(f"{self.name} models do not support a draft model")
+
+    def warm_up(self):
+        """
+        Prepares the model before its first call (see warm_up). Nothing to do
+        for this backend.
+        """
+
+    def acquire(self, draft_model=None):
+        """
+        Called by every Agent that uses this backend, so that its models are not
+        evicted from memory while the Agent lives. Nothing to do for this backend.
+        """
+
+    def release(self, draft_model=None):
+        """Undoes acquire once the Agent is gone."""
+
+    async def _limited(self, fn, *args):
+        async with self.semaphore:
+            return await fn(*args)
+
+
+class HuggingFaceBackend(Backend):
+    """
+    Local transformers model. A model can only run one generate call at a
+    time, so a list of conversations is sent as one batched call. The model
+    is loaded on its first call, or earlier by warm_up.
+    """
+    name = "huggingface"
+    supports_draft = True
+
+    def __init__(self, model, max_concurrency=1):
+        # concurrent generate calls would share the model's weights and hooks
+        super().__init__(model, max_concurrency=max_concurrency)
+
+    def load(self):
+        """
+        Loads the tokenizer and model on first use (see huggingface_lib.load_model).
+        They are not kept here, so that the model registry can free them.
+        """
+        from . import huggingface_lib
+        return huggingface_lib.load_model(self.model)
+
+    def acquire(self, draft_model=None):
+        for name in [self.model, draft_model]:
+            if name is not None:
+                registry.models.acquire(name)
+
+    def release(self, draft_model=None):
+        for name in [self.model, draft_model]:
+            if name is not None:
+                registry.models.release(name)
+
+    @property
+    def tokenizer_load(self):
+        return self.load()[0]
+
+    @property
+    def model_load(self):
+        return self.load()[1]
+
+    def warm_up(self):
+        """Loads the model and runs one short generate call, which also triggers torch.compile."""
+        from . import huggingface_lib
+        run(self._generate(huggingface_lib.warm_up))
+
+    async def respond(self, messages_list, caches=None, stop_patterns=None, stop_sequences=None, draft_model=None):
+        from . import huggingface_lib
+        stop_patterns = _all_patterns(stop_patterns, stop_sequences)
+        if len(messages_list) == 1 and caches and caches[0] is not None:
+            # the key/value cache path decodes without the draft model
+            return [await self._generate(huggingface_lib.get_output_cached, messages_list[0], caches[0], stop_patterns)]
+        return await self._generate(huggingface_lib.get_outputs, messages_list, stop_patterns, draft_model=draft_model)
+
+    async def sample(self, messages, n, stop_patterns=None, stop_sequences=None, draft_model=None):
+        from . import huggingface_lib
+        stop_patterns = _all_patterns(stop_patterns, stop_sequences)
+        return await self._generate(huggingface_lib.get_output_samples, messages, n, stop_patterns, draft_model=draft_model)
+
+    async def sample_batch(self, messages_list, n, stop_patterns=None, stop_sequences=None, draft_model=None):
+        from . import huggingface_lib
+        stop_patterns = _all_patterns(stop_patterns, stop_sequences)
+        return await self._generate(huggingface_lib.get_output_samples_batch, messages_list, n, stop_patterns, draft_model=draft_model)
+
+    def load_draft(self, draft_model):
+        """
+        :param draft_model: A small model of the same family, sharing the tokenizer. It is
+            kept in huggingface_lib's model cache next to the main model.
+        :return: The loaded draft model, or None if draft_model is None.
+        """
+        if draft_model is None:
+            return None
+        from . import huggingface_lib
+        return huggingface_lib.load_model(draft_model)[1]
+
+    def count_tokens(self, text):
+        return len(self.tokenizer_load(text, add_special_tokens=False).input_ids)
+
+    async def evaluate(self, messages_list, response_format, values_list=None):
+        from . import huggingface_lib
+        schema = response_format["json_schema"]["schema"] if values_list is not None else None
+        return await self._generate(huggingface_lib.get_belief_outputs, messages_list, schema, values_list)
+
+    async def _generate(self, fn, *args, **kwargs):
+        """
+        Calls fn(tokenizer, model, *args) in a worker thread. The models are
+        loaded there too, so a first call does not block the backend loop.
+        A draft_model keyword is loaded and passed as the last argument.
+        """
+        def call():
+            tokenizer, model = self.load()
+            extra = (self.load_draft(kwargs["draft_model"]),) if "draft_model" in kwargs else ()
+            return fn(tokenizer, model, *args, *extra)
+        return await self._limited(asyncio.to_thread, call)
+
+
+class OllamaBackend(Backend):
+    """
+    Model served by Ollama. Requests go through ollama_lib's pooled session.
+    """
+    name = "ollama"
+
+    async def chat(self, messages, response_format=None, stop_sequences=None):
+        from . import ollama_lib
+        format = response_format["json_schema"]["schema"] if response_format else None
+        return await asyncio.to_thread(ollama_lib.chat, self.model, messages, format, stop_sequences)
+
+    def warm_up(self):
+        """Asks the Ollama server to load the model into memory."""
+        from . import ollama_lib
+        ollama_lib.load(self.model)
+
+
+class OpenAIBackend(Backend):
+    """
+    OpenAI (or compatible) chat completions through openai_lib's async client.
+    """
+    name = "openai"
+
+    def __init__(self, model, max_concurrency=16):
+        # the request/token budgets are enforced by openai_lib.rate_limiter
+        super().__init__(model, max_concurrency=max_concurrency)
+
+    async def chat(self, messages, response_format=None, stop_sequences=None):
+        from . import openai_lib
+        return await openai_lib.aget_gpt_output(self.model, messages, response_format, stop_sequences)
+
+    def warm_up(self):
+        """Reads ./.env and creates the clients."""
+        from . import openai_lib
+        openai_lib.setup()
+
+
+def trim_at_stop(text, stop_patterns):
+    """Cuts `text` right after the earliest match of any of the patterns."""
+    if not stop_patterns or not isinstance(text, str):
+        return text
+    ends = [match.end() for match in (re.search(pattern, text) for pattern in stop_patterns) if match]
+    return text[:min(ends)] if ends else text
+
+
+def _all_patterns(stop_patterns, stop_sequences):
+    patterns = list(stop_patterns or []) + [re.escape(sequence) for sequence in stop_sequences or []]
+    return patterns or None
+
+
+# ---- Backend selection ----
+backend_types = {
+    "huggingface": HuggingFaceBackend,
+    "ollama": OllamaBackend,
+    "openai": OpenAIBackend,
+}
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+def resolve_backend(model):
+    """
+    Picks the backend for a model name.
+
+    "openai/<model>", "ollama/<model>" and "huggingface/<model>" select a
+    backend explicitly. Otherwise names starting with "gpt-" go to OpenAI,
+    names with a tag (e.g. "llama3.2:1b") go to Ollama, and everything else is
+    loaded with transformers.
+
+    :return: (backend name, model name without the backend prefix)
+    """
+    prefix, _, rest = model.partition("/")
+    if prefix in backend_types and rest:
+        return prefix, rest
+    if model.startswith("gpt-"):
+        return "openai", model
+    if ":" in model:
+        return "ollama", model
+    return "huggingface", model
+
+
+def register_backend(model, backend):
+    """
+    Uses `backend` for every Agent whose model is `model`, e.g. to point a
+    model name at a local stand-in server or to change its concurrency limit.
+    """
+    _backends[model] = backend
+
+
+def get_backend(model):
+    """
+    Returns the shared Backend instance for a model name. Creating it does
+    not load the model; that happens on its first call or in warm_up.
+    """
+    with _backends_lock:
+        if model not in _backends:
+            name, model_name = resolve_backend(model)
+            _backends[model] = backend_types[name](model_name)
+        return _backends[model]
+
+
+def warm_up(models):
+    """
+    Loads and warms up the backends of `models` in a background thread, e.g.
+    while the dataset is being prepared. Calls that need a model before it is
+    ready wait for it to finish loading.
+
+    :param models: Model names as given to the Agents; None entries are skipped.
+    :return: A concurrent.futures.Future, done when every model is ready.
+        Its result() raises the first error.
+    """
+    future = concurrent.futures.Future()
+
+    def target():
+        try:
+            for model in models:
+                if model is not None:
+                    get_backend(model).warm_up()
+        except BaseException as error:
+            future.set_exception(error)
+        else:
+            future.set_result(None)
+
+    threading.Thread(target=target, name="mad-warm-up", daemon=True).start()
+    return future
@@ -0,0 +1,151 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from . import metrics
+
+
+class ResponseCache:
+    """
+    Content-addressed store of model responses in a SQLite file.
+
+    Entries are keyed on a hash of everything that determines a response
+    (backend, model, messages, sampling parameters and seed). When the stored
+    values grow past max_bytes, the least recently used entries are evicted.
+    """
+    def __init__(self, path, max_bytes=1024**3, seed=None):
+        """
+        :param path: The SQLite file. Its folder is created if needed.
+        :param max_bytes: Size budget of the stored values.
+        :param seed: Part of every key; set a different seed per run so that
+            repeated runs of the same questions are not served the same samples.
+        """
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.seed = seed
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT, size INTEGER, last_used REAL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self._db.commit()
+        self.size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def key(self, **parts):
+        parts["seed"] = self.seed
+        text = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            row = self._db.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._db.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._db.commit()
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        text = json.dumps(value, ensure_ascii=False)
+        size = len(text.encode("utf-8"))
+        with self._lock:
+            old = self._db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, text, size, time.time()),
+            )
+            self.size += size - (old[0] if old else 0)
+            self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        while self.size > self.max_bytes:
+            rows = self._db.execute("SELECT key, size FROM responses ORDER BY last_used LIMIT 64").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.size -= size
+                if self.size <= self.max_bytes:
+                    break
+
+    def stats(self):
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": entries,
+            "bytes": self.size,
+        }
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+# ---- Global cache, off unless enabled ----
+_cache = None
+
+def enable(path=".cache/responses.sqlite", max_bytes=1024**3, seed=None):
+    """Turns on the response cache for every model call in this process."""
+    global _cache
+    if _cache is not None:
+        _cache.close()
+    _cache = ResponseCache(path, max_bytes=max_bytes, seed=seed)
+    return _cache
+
+
+def disable():
+    global _cache
+    if _cache is not None:
+        _cache.close()
+    _cache = None
+
+
+def get_cache():
+    return _cache
+
+
+def set_seed(seed):
+    """Changes the seed that is part of every key, e.g. once per benchmark run."""
+    if _cache is not None:
+        _cache.seed = seed
+
+
+def key(**parts):
+    """Returns the cache key of a call, or None if the cache is disabled."""
+    if _cache is None:
+        return None
+    return _cache.key(**parts)
+
+
+def get(key):
+    if _cache is None or key is None:
+        return None
+    value = _cache.get(key)
+    if value is not None:
+        metrics.note(cache_hits=1)
+    return value
+
+
+def put(key, value):
+    if _cache is not None and key is not None:
+        _cache.put(key, value)
+
+
+if os.environ.get("MAD_RESPONSE_CACHE"):
+    enable(os.environ["MAD_RESPONSE_CACHE"])
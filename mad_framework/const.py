@@ -35,6 +35,26 @@ Current Strength: {3}
 }}"""
 
 
+belief_list_eval_prompt = """{0}\nDiscussion:\n{1}\n\nBased on the above discussion and current beliefs, update the strength of each of the following beliefs.
+Beliefs:
+{2}
+
+### **Update Rules (STRICT)**  
+1. **DO NOT modify the belief texts.**  
+2. **Only adjust the strengths between 1 and 5.**  
+3. If a belief was **reinforced**, increase its strength slightly (**max = 5**).  
+4. If a belief was **challenged**, decrease its strength slightly (**min = 1**).  
+5. Return every belief exactly once, in the same order. Do not add or remove any beliefs.
+
+### **Return JSON format (STRICTLY FOLLOWED)**  
+```json
+{{
+    "beliefs": [
+        {{"belief": "<belief text>", "updated_strength": <int between 1-5>}}
+    ]
+}}"""
+
+
 persona_dict = {
 1: "You have a very low open-mindedness. Your Open-mindedness level is 1.",
 2: "You have a low open-mindedness. Your Open-mindedness level is 2.",
@@ -65,4 +85,30 @@ belief_json_schema = {
             "required": ["belief", "updated_strength"]
         }
     }
-}
\ No newline at end of file
+}
+
+
+belief_list_json_schema = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "belief_list_schema",
+        "schema": {
+            "type": "object",
+            "properties": {
+                "beliefs": {
+                    "type": "array",
+                    "items": belief_json_schema["json_schema"]["schema"],
+                    "description": "The full set of beliefs. Number of beliefs must stay the same as before."
+                }
+            },
+            "required": ["beliefs"]
+        }
+    }
+}
+
+
+# end of the "Answer: <X>; Confidence: <NN%>" line the benchmark prompts ask for
+verdict_stop_pattern = r"Answer:[^\n;]*;\s*Confidence:\s*<?\d{1,3}(?:\.\d+)?\s*%"
+
+# the same line with the answer and the confidence captured
+verdict_pattern = r"Answer:\s*<?([^\n;]*?)>?\s*;\s*Confidence:\s*<?(\d{1,3}(?:\.\d+)?)\s*%"
@@ -0,0 +1,139 @@
+import hashlib
+from . import metrics
+from .backends import run
+
+
+summary_prompt = """Summarize the earlier part of a debate below in at most {0} words. Keep the latest answer, \
+confidence and main arguments of every participant. If an earlier summary is given, update it with the new turns."""
+
+
+class ContextPolicy:
+    """
+    Keeps an agent's prompts within a token budget, measured with the agent's
+    tokenizer (see Backend.count_tokens). The newest turns are always kept;
+    older ones are dropped according to the mode:
+
+    - "window": only the agent's last `window` exchanges are kept, and older
+      turns are also dropped if the budget is still exceeded.
+    - "truncate": the oldest turns are dropped until the prompt fits.
+    - "summary": as truncate, but the dropped turns are replaced by a rolling
+      summary written by the agent's model. Each dropped turn is summarized
+      once; later summaries extend the previous one.
+    """
+    modes = ("window", "truncate", "summary")
+
+    def __init__(self, max_tokens=None, mode="truncate", window=None, summary_tokens=256):
+        """
+        :param max_tokens: Budget of a prompt in tokens. None only applies the window.
+        :param mode: One of ContextPolicy.modes.
+        :param window: Number of the agent's latest exchanges kept in window mode.
+        :param summary_tokens: Length budget of the summary in summary mode.
+        """
+        if mode not in self.modes:
+            raise ValueError(f"Unknown context mode {mode!r}, expected one of {self.modes}")
+        self.max_tokens = max_tokens
+        self.mode = mode
+        self.window = window
+        self.summary_tokens = summary_tokens
+        self._counts = {}
+        # rolling summary of the dropped turns, per prompt kind
+        self._summaries = {}
+
+    def count(self, backend, text):
+        """Tokens of `text`, memoized so that a kept turn is only tokenized once."""
+        if text not in self._counts:
+            if len(self._counts) > 4096:
+                self._counts.clear()
+            self._counts[text] = backend.count_tokens(text)
+        return self._counts[text]
+
+    def fit_messages(self, backend, messages):
+        """
+        Fits a chat history from Agent.build_messages. The system message and
+        the last message are always kept, and the kept part starts with a user
+        message. A summary is appended to the system message.
+
+        :return: A new list of messages.
+        """
+        system, rest = messages[0], messages[1:]
+        start = 0
+        if self.mode == "window" and self.window:
+            answers = [i for i, message in enumerate(rest) if message["role"] == "assistant"]
+            if len(answers) > self.window:
+                start = answers[-self.window]
+                if start > 0 and rest[start - 1]["role"] == "user":
+                    start -= 1
+
+        if self.max_tokens is not None:
+            # about 4 tokens of chat template per message
+            budget = self.max_tokens - self.count(backend, system["content"]) - 4
+            if self.mode == "summary":
+                budget -= self.summary_tokens
+            sizes = [self.count(backend, message["content"]) + 4 for message in rest]
+            total = sum(sizes[start:])
+            while total > budget and start < len(rest) - 1:
+                # drop the oldest exchange: up to the next user message
+                step = start + 1
+                while step < len(rest) - 1 and rest[step]["role"] != "user":
+                    step += 1
+                total -= sum(sizes[start:step])
+                start = step
+
+        if self.mode == "summary" and start > 0:
+            dropped = [("You: " if message["role"] == "assistant" else "") + message["content"] for message in rest[:start]]
+            summary = self.summarize(backend, "messages", dropped)
+            system = dict(system, content=system["content"] + "\n\nSummary of the earlier discussion:\n" + summary)
+        return [system] + rest[start:]
+
+    def fit_turns(self, backend, turns, name, fixed_tokens=0):
+        """
+        Fits the discussion turns of a belief evaluation prompt.
+
+        :param turns: The discussion, one "<agent>: <response>" string per turn.
+        :param name: The agent's name, which marks its own turns for the window.
+        :param fixed_tokens: Tokens of the rest of the prompt.
+        :return: The kept turns, preceded by the summary in summary mode.
+        """
+        start = 0
+        if self.mode == "window" and self.window:
+            own = [i for i, turn in enumerate(turns) if turn.startswith(f"{name}: ")]
+            if len(own) > self.window:
+                start = own[-self.window - 1] + 1
+
+        if self.max_tokens is not None:
+            budget = self.max_tokens - fixed_tokens
+            if self.mode == "summary":
+                budget -= self.summary_tokens
+            sizes = [self.count(backend, turn) for turn in turns]
+            total = sum(sizes[start:])
+            while total > budget and start < len(turns) - 1:
+                total -= sizes[start]
+                start += 1
+
+        if self.mode == "summary" and start > 0:
+            summary = self.summarize(backend, "turns", turns[:start])
+            return [f"Summary of the earlier discussion: {summary}"] + turns[start:]
+        return turns[start:]
+
+    def summarize(self, backend, kind, dropped):
+        """
+        Returns the summary of the dropped turns. Only the turns dropped since
+        the last call are sent to the model, together with the previous summary.
+        """
+        state = self._summaries.get(kind)
+        if (state is None or state["turns"] > len(dropped)
+                or state["turns"] and _fingerprint(dropped[state["turns"] - 1]) != state["last"]):
+            state = {"turns": 0, "last": None, "summary": ""}
+        new = dropped[state["turns"]:]
+        if new:
+            earlier = f"Earlier summary:\n{state['summary']}\n\nNew turns:\n" if state["summary"] else ""
+            messages = [{"role": "system", "content": summary_prompt.format(self.summary_tokens * 3 // 4)},
+                        {"role": "user", "content": earlier + "\n".join(new)}]
+            outputs, stats = run(metrics.timed("summary", backend, 1, backend.respond([messages])))
+            state = {"turns": len(dropped), "last": _fingerprint(dropped[-1]), "summary": outputs[0][0].strip()}
+        self._summaries[kind] = state
+        return state["summary"]
+
+
+def _fingerprint(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
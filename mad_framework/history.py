@@ -0,0 +1,136 @@
+class MessageHistory:
+    """
+    The chat history of one agent, kept between its turns.
+
+    Agent.build_messages used to rebuild the whole history from the agent
+    log on every turn. This class produces the same messages, but only
+    appends the rounds finished since the agent's last turn; the messages
+    after its last own response are rebuilt every time, since responses of
+    the other agents may still join them.
+
+    The part that is kept assumes that the agent log only grows. If it was
+    built while a response of another agent was still missing, and that
+    response has arrived since, the history is built again from the start.
+    """
+    def __init__(self):
+        self.reset(None, None, None, None)
+
+    def reset(self, name, system_text, task_prompt, agent_log, simultaneous_rounds=0):
+        self.key = (name, system_text, task_prompt, simultaneous_rounds)
+        self.agent_log = agent_log
+        self.messages = []
+        # number of own responses already in self.messages
+        self.rounds = 0
+        # (agent, round) responses that were missing when a kept round was built
+        self.gaps = []
+        if name is not None:
+            self.messages.append({"role": "system", "content": f"You are {name}. {system_text}"})
+            # in a simultaneous first round every agent answered the task itself
+            if '1' in name or simultaneous_rounds > 0:
+                self.messages.append({"role": "user", "content": task_prompt})
+
+    def build(self, name, system_text, task_prompt, agent_log, simultaneous_rounds=0):
+        """
+        :param name: The agent's name, a key of agent_log.
+        :param agent_log: The responses of every agent so far, see Debate.agent_log.
+        :param simultaneous_rounds: Number of leading rounds in which every agent answered
+            without seeing the others' answers of that round (see Team.shared_first_round).
+            Their answers are shown after the agent's own one, as it happened.
+        :return: A new list with the chat messages for the agent's next turn.
+        """
+        if ((name, system_text, task_prompt, simultaneous_rounds) != self.key or agent_log is not self.agent_log
+                or len(agent_log[name]) < self.rounds
+                or any(len(agent_log[agent]) > r for agent, r in self.gaps)):
+            self.reset(name, system_text, task_prompt, agent_log, simultaneous_rounds)
+
+        names = list(agent_log)
+        position = names.index(name)
+        before, after = names[:position], names[position + 1:]
+        own_rounds = len(agent_log[name])
+
+        def previous(r):
+            # agents whose round r answers come after the agent's own one
+            return before + after if r < simultaneous_rounds else after
+
+        def current(r):
+            # agents whose round r answers come before the agent's own one
+            return [] if r < simultaneous_rounds else before
+
+        for r in range(self.rounds, own_rounds):
+            user_msgs = []
+            if r > 0:
+                user_msgs += self._responses(agent_log, previous(r - 1), r - 1, self.gaps)
+            user_msgs += self._responses(agent_log, current(r), r, self.gaps)
+            if user_msgs:
+                if self.messages[-1]["role"].lower() == "user":
+                    self._extend_last(self.messages, "\n" + "\n".join(user_msgs) + "\n\n" + f"###\n\n" + task_prompt)
+                else:
+                    self.messages.append({"role": "user", "content": "\n".join(user_msgs) + f"###\n\n" + task_prompt})
+            assistant_msg = agent_log[name][r].lstrip(f"{name}: ")
+            self.messages.append({"role": "assistant", "content": assistant_msg})
+        self.rounds = own_rounds
+
+        messages = list(self.messages)
+        user_msgs = self._responses(agent_log, previous(own_rounds - 1), own_rounds - 1) if own_rounds > 0 else []
+        if len(user_msgs) > 0:
+            if messages[-1]["role"].lower() == "user":
+                self._extend_last(messages, "\n" + "\n".join(user_msgs) + "\n\n" + f"###\n\n" + task_prompt)
+            else:
+                messages.append({"role": "user", "content": "\n".join(user_msgs)})
+
+        # If any agents already went in the current round, add those to the first user prompt along with the task_prompt, else just add task_prompt
+        new_user_prompts = self._responses(agent_log, before + after, own_rounds) if own_rounds >= simultaneous_rounds else []
+        if len(new_user_prompts) > 0:
+            if messages[-1]["role"].lower() == "assistant" or messages[-1]["role"].lower() == "system":
+                messages.append({"role": "user", "content": "\n".join(new_user_prompts) + "\n\n" + f"###\n\n" + task_prompt})
+            else:
+                self._extend_last(messages, "\n" + "\n".join(new_user_prompts) + "\n" + f"###\n\n" + task_prompt)
+        else:
+            if messages[-1]["role"].lower() == "user":
+                if len(messages) != 2:
+                    self._extend_last(messages, "\n" + f"###\n\n" + task_prompt)
+        return messages
+
+    def build_simultaneous(self, name, system_text, task_prompt, agent_log):
+        """
+        Chat history for the simultaneous speaking mode, where every agent
+        answers round r seeing only rounds < r: the task, then for every
+        finished round the agent's own answer followed by one user message
+        with the other agents' answers of that round and the task again.
+
+        :return: A new list with the chat messages for the agent's next turn.
+        """
+        if (("simultaneous", name, system_text, task_prompt) != self.key or agent_log is not self.agent_log
+                or len(agent_log[name]) < self.rounds
+                or any(len(agent_log[agent]) > r for agent, r in self.gaps)):
+            self.reset(name, system_text, task_prompt, agent_log)
+            self.key = ("simultaneous", name, system_text, task_prompt)
+            # every agent gets the task, not only the first one
+            del self.messages[1:]
+            self.messages.append({"role": "user", "content": task_prompt})
+
+        others = [agent for agent in agent_log if agent != name]
+        prefix = f"{name}: "
+        for r in range(self.rounds, len(agent_log[name])):
+            response = agent_log[name][r]
+            self.messages.append({"role": "assistant", "content": response[len(prefix):] if response.startswith(prefix) else response})
+            user_msgs = self._responses(agent_log, others, r, self.gaps)
+            self.messages.append({"role": "user", "content": "\n".join(user_msgs) + "\n\n" + f"###\n\n" + task_prompt})
+        self.rounds = len(agent_log[name])
+        return list(self.messages)
+
+    @staticmethod
+    def _responses(agent_log, agents, r, gaps=None):
+        """Round r responses of `agents` that exist, in order; missing ones are added to gaps."""
+        responses = []
+        for agent in agents:
+            if len(agent_log[agent]) > r:
+                responses.append(agent_log[agent][r])
+            elif gaps is not None:
+                gaps.append((agent, r))
+        return responses
+
+    @staticmethod
+    def _extend_last(messages, text):
+        # a new dict, so lists returned earlier keep their content
+        messages[-1] = dict(messages[-1], content=messages[-1]["content"] + text)
@@ -1,37 +1,380 @@
-from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
+import os
+import re
+import glob
+import json
+import struct
+import contextlib
+import threading
+import torch
+import huggingface_hub
+from transformers import AutoModelForCausalLM, AutoTokenizer, BatchEncoding, BitsAndBytesConfig, DynamicCache, LogitsProcessor, LogitsProcessorList, StoppingCriteria, StoppingCriteriaList
+from transformers.generation.streamers import BaseStreamer
+from . import cache, metrics, registry
+
+
+# ---- Load profiles ----
+# How load_model loads a model:
+#   dtype:         torch dtype name of the weights, or "auto" for the checkpoint's own
+#   quantization:  "bnb_4bit" (bitsandbytes NF4, needs a GPU), "int8_dynamic" (torch
+#                  dynamic int8 quantization of the linear layers, CPU) or None
+#   device_map:    passed to from_pretrained, e.g. "auto" or "cpu"
+#   threads:       torch intra-op threads (CPU inference), None keeps torch's default
+#   compile:       run the forward pass through torch.compile
+#   attention:     attn_implementation, e.g. "sdpa" (PyTorch scaled dot product attention)
+LOAD_PROFILES = {
+    "gpu_4bit": {"dtype": "bfloat16", "quantization": "bnb_4bit", "device_map": "auto", "threads": None,
+                 "compile": False, "attention": "sdpa"},
+    "gpu_bf16": {"dtype": "bfloat16", "quantization": None, "device_map": "auto", "threads": None,
+                 "compile": False, "attention": "sdpa"},
+    "cpu": {"dtype": "float32", "quantization": None, "device_map": "cpu", "threads": None,
+            "compile": False, "attention": "sdpa"},
+    "cpu_bf16": {"dtype": "bfloat16", "quantization": None, "device_map": "cpu", "threads": None,
+                 "compile": False, "attention": "sdpa"},
+    "cpu_int8": {"dtype": "float32", "quantization": "int8_dynamic", "device_map": "cpu", "threads": None,
+                 "compile": False, "attention": "sdpa"},
+}
+
+# profile per model name, see set_load_profile
+_model_profiles = {}
+
+
+def default_profile():
+    """The 4-bit GPU profile if CUDA is available, else plain float32 on CPU."""
+    return "gpu_4bit" if torch.cuda.is_available() else "cpu"
+
+
+def resolve_profile(profile):
+    """
+    :param profile: A name in LOAD_PROFILES, a dict of settings, or a dict with a "base"
+        profile name and the settings that differ from it. None is default_profile().
+    :return: The complete settings dict.
+    """
+    if profile is None:
+        profile = default_profile()
+    if isinstance(profile, str):
+        if profile not in LOAD_PROFILES:
+            raise ValueError(f"Unknown load profile {profile!r}, expected one of {list(LOAD_PROFILES)}")
+        return dict(LOAD_PROFILES[profile])
+    overrides = dict(profile)
+    settings = resolve_profile(overrides.pop("base", None))
+    unknown = set(overrides) - set(settings)
+    if unknown:
+        raise ValueError(f"Unknown load profile settings: {sorted(unknown)}")
+    settings.update(overrides)
+    return settings
+
+
+def set_load_profile(model_name, profile):
+    """
+    Loads `model_name` with `profile` (see resolve_profile) from now on. A model
+    that is already in the cache keeps the profile it was loaded with.
+    """
+    resolve_profile(profile)
+    _model_profiles[model_name] = profile
 
 
 # ---- Global cache ----
-_model_cache = {}
+# Loaded models, within the memory budget registry.models.max_bytes. Models that
+# no live Agent uses are freed least recently used first to make room.
+# Loads run one at a time, so a warm-up thread and a first call do not load a
+# model twice.
+_model_cache = registry.models
+
+
+def _empty_device_cache():
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+_model_cache.on_free = _empty_device_cache
+
+
+def load_model(model_name, profile=None):
+    """
+    Load model+tokenizer once per model name, reuse for later calls.
+
+    :param profile: Load profile (see resolve_profile). None uses the profile set
+        with set_load_profile, else default_profile().
+    """
+    return _model_cache.get(model_name, lambda: _load_model(model_name, profile), footprint,
+                            lambda: estimate_footprint(model_name, profile))
+
+
+def footprint(loaded):
+    """Bytes of the weights and buffers of a (tokenizer, model), quantized weights included."""
+    tokenizer, model = loaded
+    total, seen = 0, set()
+    for value in model.state_dict().values():
+        for tensor in (value if isinstance(value, tuple) else (value,)):
+            if not isinstance(tensor, torch.Tensor):
+                continue
+            # tied weights (e.g. embeddings and lm_head) are counted once
+            pointer = tensor.data_ptr()
+            if pointer and pointer in seen:
+                continue
+            seen.add(pointer)
+            total += tensor.numel() * tensor.element_size()
+    return total
+
+
+# bytes per element of the safetensors dtypes
+_SAFETENSORS_BYTES = {"F64": 8, "I64": 8, "U64": 8, "F32": 4, "I32": 4, "U32": 4, "F16": 2, "BF16": 2, "I16": 2,
+                      "U16": 2, "F8_E4M3": 1, "F8_E5M2": 1, "I8": 1, "U8": 1, "BOOL": 1}
+# bytes per parameter of the quantized weights, roughly (scales included)
+_QUANTIZED_BYTES = {"bnb_4bit": 0.5, "int8_dynamic": 1}
+
+
+def estimate_footprint(model_name, profile=None):
+    """
+    Expected footprint of load_model(model_name, profile) before it is loaded,
+    from the parameter counts in the checkpoint's safetensors headers (a local
+    folder or the Hugging Face cache, else the Hub's metadata), scaled to the
+    profile's dtype and quantization.
 
-def load_model(model_name):
-    """Load model+tokenizer once per model name, reuse for later calls."""
-    if model_name in _model_cache:
-        return _model_cache[model_name]   # return already-loaded copy
+    :return: Bytes, or None if the checkpoint has no safetensors files or cannot be reached.
+    """
+    counts = _checkpoint_parameters(model_name)
+    if not counts:
+        return None
+    settings = resolve_profile(profile if profile is not None else _model_profiles.get(model_name))
+    params = sum(counts.values())
+    if settings["quantization"] in _QUANTIZED_BYTES:
+        return int(params * _QUANTIZED_BYTES[settings["quantization"]])
+    if settings["dtype"] in (None, "auto"):
+        return sum(count * _SAFETENSORS_BYTES.get(dtype, 4) for dtype, count in counts.items())
+    return params * getattr(torch, settings["dtype"]).itemsize
+
+
+def _checkpoint_parameters(model_name):
+    """Parameter count per safetensors dtype of a checkpoint, or None."""
+    folder = model_name if os.path.isdir(model_name) else None
+    if folder is None:
+        try:
+            folder = huggingface_hub.snapshot_download(model_name, allow_patterns=["*.safetensors"], local_files_only=True)
+        except Exception:
+            folder = None
+    files = glob.glob(os.path.join(folder, "*.safetensors")) if folder is not None else []
+    if not files:
+        if os.path.isdir(model_name):
+            return None
+        try:
+            return dict(huggingface_hub.get_safetensors_metadata(model_name).parameter_count)
+        except Exception:
+            # offline, a private model or no safetensors files
+            return None
+
+    counts = {}
+    for path in files:
+        # a safetensors file starts with the length of its JSON header, which lists every tensor
+        with open(path, "rb") as file:
+            header = json.loads(file.read(struct.unpack("<Q", file.read(8))[0]))
+        for name, tensor in header.items():
+            if name == "__metadata__":
+                continue
+            numel = 1
+            for dim in tensor["shape"]:
+                numel *= dim
+            counts[tensor["dtype"]] = counts.get(tensor["dtype"], 0) + numel
+    return counts
+
+
+def _load_model(model_name, profile):
+    settings = resolve_profile(profile if profile is not None else _model_profiles.get(model_name))
 
     # save_path = f"/nvme/AMHR/onurbilgin/models/{model_name}/"
     save_path = f"{model_name}"
     tokenizer = AutoTokenizer.from_pretrained(save_path)
 
-    quant_config = BitsAndBytesConfig(
-        load_in_4bit=True,
-        bnb_4bit_quant_type="nf4",
-        bnb_4bit_use_double_quant=True,
-        bnb_4bit_compute_dtype="bfloat16"
-    )
+    if settings["threads"]:
+        torch.set_num_threads(settings["threads"])
+
+    kwargs = {"device_map": settings["device_map"]}
+    if settings["dtype"] is not None:
+        kwargs["torch_dtype"] = settings["dtype"] if settings["dtype"] == "auto" else getattr(torch, settings["dtype"])
+    if settings["attention"] is not None:
+        kwargs["attn_implementation"] = settings["attention"]
+    if settings["quantization"] == "bnb_4bit":
+        kwargs["quantization_config"] = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_use_double_quant=True,
+            bnb_4bit_compute_dtype=settings["dtype"] if settings["dtype"] not in (None, "auto") else "bfloat16"
+        )
+    elif settings["quantization"] not in (None, "int8_dynamic"):
+        raise ValueError(f"Unknown quantization {settings['quantization']!r}")
 
     model = AutoModelForCausalLM.from_pretrained(
         save_path,
-        quantization_config=quant_config,
-        device_map="auto",
+        **kwargs,
     )
 
-    # store in cache
-    _model_cache[model_name] = (tokenizer, model)
+    if settings["quantization"] == "int8_dynamic":
+        # int8 weights for the linear layers, activations quantized on the fly (CPU only)
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    if settings["compile"]:
+        model.forward = torch.compile(model.forward, dynamic=True)
+
     return tokenizer, model
 
 
-def get_output(tokenizer, model, msg):
+def warm_up(tokenizer, model):
+    """
+    Runs one short generate call, so that the first real call does not pay for
+    torch.compile, kernel selection or lazily allocated buffers.
+    """
+    inputs = tokenizer(tokenizer.apply_chat_template([{"role": "user", "content": "Hi"}], tokenize=False,
+                                                     add_generation_prompt=True), return_tensors="pt").to(model.device)
+    with torch.inference_mode():
+        model.generate(**inputs, pad_token_id=_pad_token_id(tokenizer), do_sample=False, max_new_tokens=2)
+
+
+# sampling parameters of every generate call, also part of the response cache keys
+SAMPLING = {"do_sample": True, "temperature": 0.7, "top_p": 0.9}
+
+
+def _cache_key(call, model, msg, max_new_tokens, extra=None, stop_patterns=None):
+    return cache.key(backend="huggingface", call=call, model=model.name_or_path, msg=msg,
+                     params={"max_new_tokens": max_new_tokens, "stop": stop_patterns, **SAMPLING}, extra=extra)
+
+
+class RegexStoppingCriteria(StoppingCriteria):
+    """
+    Stops a row as soon as its generated text matches one of the patterns,
+    e.g. once the final "Answer: ...; Confidence: NN%" line is complete.
+    Only the last `window` generated tokens are decoded at every step.
+    """
+    def __init__(self, tokenizer, patterns, prompt_len, window=32):
+        self.tokenizer = tokenizer
+        self.patterns = [re.compile(pattern) for pattern in patterns]
+        self.prompt_len = prompt_len
+        self.window = window
+
+    def __call__(self, input_ids, scores, **kwargs):
+        done = []
+        for row in input_ids[:, self.prompt_len:]:
+            text = self.tokenizer.decode(row[-self.window:], skip_special_tokens=True)
+            done.append(any(pattern.search(text) for pattern in self.patterns))
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+
+def _stopping_criteria(tokenizer, stop_patterns, prompt_len):
+    if not stop_patterns:
+        return None
+    return StoppingCriteriaList([RegexStoppingCriteria(tokenizer, stop_patterns, prompt_len)])
+
+
+class FirstTokenStreamer(BaseStreamer):
+    """
+    Reports the time to first token of a generate call to metrics.
+    generate puts the prompt first, then every decoding step.
+    """
+    def __init__(self):
+        self.puts = 0
+
+    def put(self, value):
+        self.puts += 1
+        if self.puts == 2:
+            metrics.first_token()
+
+    def end(self):
+        pass
+
+
+def _streamer():
+    # only while a call is measured, see metrics.timed
+    return FirstTokenStreamer() if metrics.active() else None
+
+
+def _generate(model, draft, **kwargs):
+    """
+    model.generate, with assisted (speculative) decoding if a draft model is
+    given: the draft proposes a few tokens, and the model checks all of them
+    in one forward pass and keeps the ones it agrees with. transformers only
+    supports it for a single row without num_return_sequences.
+
+    :param draft: A small model of the same family (same tokenizer), or None.
+    :return: (outputs, draft_count) where draft_count counts the forward passes
+        of both models, see _draft_token_count. None without a draft model.
+    """
+    if draft is None:
+        with _model_locks(model):
+            return model.generate(**kwargs), None
+
+    draft_count = {"model": 0, "draft": 0}
+
+    def counter(name):
+        def hook(module, args, output):
+            draft_count[name] += 1
+        return hook
+
+    # the hooks count every forward pass of the two models, so no other call may run
+    # on them meanwhile (a draft model can be shared by several main models)
+    with _model_locks(model, draft):
+        handles = [model.register_forward_hook(counter("model")), draft.register_forward_hook(counter("draft"))]
+        try:
+            outputs = model.generate(**kwargs, assistant_model=draft)
+        finally:
+            for handle in handles:
+                handle.remove()
+    return outputs, draft_count
+
+
+# id(model) -> lock held during a generate call of the model, see _generate
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def _model_locks(*models):
+    """Holds the lock of every model, always taken in the same order."""
+    with _locks_lock:
+        locks = [_locks.setdefault(id(model), threading.Lock()) for model in sorted(models, key=id)]
+    with contextlib.ExitStack() as stack:
+        for lock in locks:
+            stack.enter_context(lock)
+        yield
+
+
+def _draft_token_count(draft_count, generated_token_count):
+    """
+    Acceptance stats of one assisted generate call. Every draft forward pass
+    proposes one token, and every model forward pass keeps the accepted
+    proposals plus one token of its own.
+    """
+    accepted = max(generated_token_count - draft_count["model"], 0)
+    drafted = max(draft_count["draft"], accepted)
+    return {"draft_token": drafted, "accepted_token": accepted,
+            "acceptance_rate": accepted / drafted if drafted else 0.0}
+
+
+def _note_draft(token_count):
+    if "draft_token" in token_count:
+        metrics.note(draft_token=token_count["draft_token"], accepted_token=token_count["accepted_token"])
+
+
+def _cached_rows(keys, generate):
+    """
+    Serves a batch from the response cache and calls generate(missing) only
+    for the rows that are not cached; their results are stored.
+    """
+    results = [cache.get(key) for key in keys]
+    missing = [i for i, result in enumerate(results) if result is None]
+    if missing:
+        for i, result in zip(missing, generate(missing)):
+            results[i] = result
+            cache.put(keys[i], result)
+    return results
+
+
+def get_output(tokenizer, model, msg, stop_patterns=None, draft=None):
+    """
+    :param draft: Optional draft model for assisted decoding (see _generate).
+        The token count then also holds the draft_token, accepted_token and
+        acceptance_rate of the call.
+    """
+    key = _cache_key("chat", model, msg, 256, stop_patterns=stop_patterns)
+    hit = cache.get(key)
+    if hit is not None:
+        return tuple(hit)
 
     text = tokenizer.apply_chat_template(
         msg, tokenize=False, add_generation_prompt=True
@@ -41,26 +384,55 @@ def get_output(tokenizer, model, msg):
 
     prompt_token_count = inputs.input_ids.shape[1]
 
-    outputs = model.generate(
+    outputs, draft_count = _generate(
+        model, draft,
         **inputs,
-        pad_token_id=tokenizer.pad_token_id or tokenizer.eos_token_id,
-        do_sample=True,
+        pad_token_id=_pad_token_id(tokenizer),
         max_new_tokens=256,
-        temperature=0.7,
-        top_p=0.9,
+        **SAMPLING,
+        stopping_criteria=_stopping_criteria(tokenizer, stop_patterns, prompt_token_count),
+        streamer=_streamer(),
     )
 
     generated_token_count = outputs.shape[1] - prompt_token_count
     token_count = {"prompt_token": prompt_token_count, "generated_token": generated_token_count}
+    if draft_count is not None:
+        token_count.update(_draft_token_count(draft_count, generated_token_count))
+    metrics.note(prompt_token=prompt_token_count, generated_token=generated_token_count)
+    _note_draft(token_count)
 
     new_tokens = outputs[0][inputs["input_ids"].shape[1]:]
     result = tokenizer.decode(new_tokens, skip_special_tokens=True)
 
+    cache.put(key, [result, token_count])
     return result, token_count
 
 
+class PrefixCache:
+    """
+    Key/value cache of one conversation, kept between calls of get_output_cached.
+    token_ids are the tokens whose keys/values are stored in past_key_values.
+    """
+    def __init__(self):
+        self.past_key_values = None
+        self.token_ids = []
+
+    def clear(self):
+        self.past_key_values = None
+        self.token_ids = []
 
-def get_belief_output(tokenizer, model, msg):
+
+def get_output_cached(tokenizer, model, msg, prefix_cache, stop_patterns=None):
+    """
+    Same as get_output, but only prefills the part of the prompt that is not
+    already in `prefix_cache`. The cache is updated in place with the new
+    prompt and the generated tokens, so the next turn of the same conversation
+    only prefills the newly appended messages.
+    """
+    key = _cache_key("chat", model, msg, 256, stop_patterns=stop_patterns)
+    hit = cache.get(key)
+    if hit is not None:
+        return tuple(hit)
 
     text = tokenizer.apply_chat_template(
         msg, tokenize=False, add_generation_prompt=True
@@ -68,18 +440,492 @@ def get_belief_output(tokenizer, model, msg):
 
     inputs = tokenizer(text, return_tensors="pt").to(model.device)
 
-    outputs = model.generate(
+    prompt_token_count = inputs.input_ids.shape[1]
+    ids = inputs.input_ids[0].tolist()
+
+    kv_cache = prefix_cache.past_key_values
+    reused = 0
+    if kv_cache is not None:
+        for cached_id, new_id in zip(prefix_cache.token_ids, ids):
+            if cached_id != new_id:
+                break
+            reused += 1
+        # generate needs at least one token that is not in the cache
+        reused = min(reused, prompt_token_count - 1)
+        if reused > 0:
+            kv_cache.crop(reused)
+        else:
+            kv_cache = None
+    if kv_cache is None:
+        kv_cache = DynamicCache()
+
+    outputs, _ = _generate(model, None,
         **inputs,
-        pad_token_id=tokenizer.pad_token_id or tokenizer.eos_token_id,
-        do_sample=True,
+        past_key_values=kv_cache,
+        pad_token_id=_pad_token_id(tokenizer),
+        max_new_tokens=256,
+        **SAMPLING,
+        stopping_criteria=_stopping_criteria(tokenizer, stop_patterns, prompt_token_count),
+        streamer=_streamer(),
+    )
+
+    # the cache holds every token except the last generated one
+    prefix_cache.past_key_values = kv_cache
+    prefix_cache.token_ids = outputs[0][:kv_cache.get_seq_length()].tolist()
+
+    generated_token_count = outputs.shape[1] - prompt_token_count
+    token_count = {"prompt_token": prompt_token_count, "generated_token": generated_token_count, "cached_prompt_token": reused}
+    metrics.note(prompt_token=prompt_token_count - reused, cached_prompt_token=reused, generated_token=generated_token_count)
+
+    new_tokens = outputs[0][prompt_token_count:]
+    result = tokenizer.decode(new_tokens, skip_special_tokens=True)
+
+    cache.put(key, [result, token_count])
+    return result, token_count
+
+
+def get_outputs(tokenizer, model, msgs, stop_patterns=None, draft=None):
+    """
+    Batched version of get_output: one model.generate call for a list of
+    independent conversations. Prompts are left padded so that every row
+    continues from the same position. With a draft model the conversations
+    are decoded one after another, as assisted decoding needs a single row.
+
+    Returns a list of (result, token_count), one per conversation.
+    """
+    if len(msgs) == 1 or draft is not None:
+        return [get_output(tokenizer, model, msg, stop_patterns, draft) for msg in msgs]
+
+    def generate(missing):
+        inputs = _tokenize_batch(tokenizer, model, [msgs[i] for i in missing])
+        input_len = inputs.input_ids.shape[1]
+
+        outputs, _ = _generate(model, None,
+            **inputs,
+            pad_token_id=_pad_token_id(tokenizer),
+            max_new_tokens=256,
+            **SAMPLING,
+            stopping_criteria=_stopping_criteria(tokenizer, stop_patterns, input_len),
+            streamer=_streamer(),
+        )
+
+        results = _split_rows(tokenizer, model, inputs.attention_mask.sum(dim=1).tolist(), outputs[:, input_len:])
+        _note_rows(results)
+        return results
+
+    keys = [_cache_key("chat", model, msg, 256, stop_patterns=stop_patterns) for msg in msgs]
+    return [tuple(result) for result in _cached_rows(keys, generate)]
+
+
+def get_output_samples(tokenizer, model, msg, n, stop_patterns=None, draft=None):
+    """
+    Samples n responses to the same conversation with a single prefill
+    (num_return_sequences), e.g. for agents that receive the same prompt.
+    With a draft model every sample is decoded on its own (see get_outputs).
+
+    Returns a list of (result, token_count), one per sample.
+    """
+    key = _cache_key("samples", model, msg, 256, extra=n, stop_patterns=stop_patterns)
+    hit = cache.get(key)
+    if hit is not None:
+        return [tuple(result) for result in hit]
+
+    text = tokenizer.apply_chat_template(
+        msg, tokenize=False, add_generation_prompt=True
+    )
+
+    inputs = tokenizer(text, return_tensors="pt").to(model.device)
+
+    prompt_token_count = inputs.input_ids.shape[1]
+
+    if draft is not None:
+        results = []
+        for _ in range(n):
+            outputs, draft_count = _generate(
+                model, draft,
+                **inputs,
+                pad_token_id=_pad_token_id(tokenizer),
+                max_new_tokens=256,
+                **SAMPLING,
+                stopping_criteria=_stopping_criteria(tokenizer, stop_patterns, prompt_token_count),
+                streamer=_streamer(),
+            )
+            result, token_count = _split_rows(tokenizer, model, [prompt_token_count], outputs[:, prompt_token_count:])[0]
+            token_count.update(_draft_token_count(draft_count, outputs.shape[1] - prompt_token_count))
+            _note_rows([(result, token_count)])
+            _note_draft(token_count)
+            results.append((result, token_count))
+        cache.put(key, results)
+        return results
+
+    outputs, _ = _generate(model, None,
+        **inputs,
+        pad_token_id=_pad_token_id(tokenizer),
+        max_new_tokens=256,
+        num_return_sequences=n,
+        **SAMPLING,
+        stopping_criteria=_stopping_criteria(tokenizer, stop_patterns, prompt_token_count),
+        streamer=_streamer(),
+    )
+
+    results = _split_rows(tokenizer, model, [prompt_token_count] * n, outputs[:, prompt_token_count:])
+    # the prompt is prefilled once for all samples
+    metrics.note(prompt_token=prompt_token_count, generated_token=sum(token_count["generated_token"] for result, token_count in results))
+    cache.put(key, results)
+    return results
+
+
+def get_output_samples_batch(tokenizer, model, msgs, n, stop_patterns=None, draft=None):
+    """
+    Batched version of get_output_samples: n samples of every conversation
+    in one model.generate call, each prompt prefilled once. With a draft
+    model the conversations are sampled one after another.
+
+    Returns one list of (result, token_count) per conversation.
+    """
+    if len(msgs) == 1 or draft is not None:
+        return [get_output_samples(tokenizer, model, msg, n, stop_patterns, draft) for msg in msgs]
+
+    def generate(missing):
+        inputs = _tokenize_batch(tokenizer, model, [msgs[i] for i in missing])
+        input_len = inputs.input_ids.shape[1]
+
+        outputs, _ = _generate(model, None,
+            **inputs,
+            pad_token_id=_pad_token_id(tokenizer),
+            max_new_tokens=256,
+            num_return_sequences=n,
+            **SAMPLING,
+            stopping_criteria=_stopping_criteria(tokenizer, stop_patterns, input_len),
+            streamer=_streamer(),
+        )
+
+        # the samples of a prompt are consecutive rows
+        prompt_token_counts = inputs.attention_mask.sum(dim=1).tolist()
+        rows = _split_rows(tokenizer, model, [count for count in prompt_token_counts for _ in range(n)], outputs[:, input_len:])
+        metrics.note(prompt_token=sum(prompt_token_counts), generated_token=sum(token_count["generated_token"] for result, token_count in rows))
+        return [rows[i * n:(i + 1) * n] for i in range(len(missing))]
+
+    keys = [_cache_key("samples", model, msg, 256, extra=n, stop_patterns=stop_patterns) for msg in msgs]
+    return [[tuple(result) for result in results] for results in _cached_rows(keys, generate)]
+
+
+def _tokenize_batch(tokenizer, model, msgs):
+    """Apply the chat template to every conversation and left pad them into one batch."""
+    texts = [
+        tokenizer.apply_chat_template(msg, tokenize=False, add_generation_prompt=True)
+        for msg in msgs
+    ]
+    return _pad_batch(tokenizer, model, texts)
+
+
+def _pad_batch(tokenizer, model, texts):
+    # left padded here rather than by the tokenizer, which is shared between
+    # threads and may have no pad token of its own
+    rows = tokenizer(texts).input_ids
+    width = max(len(row) for row in rows)
+    pad_id = _pad_token_id(tokenizer)
+    input_ids = torch.tensor([[pad_id] * (width - len(row)) + row for row in rows])
+    attention_mask = torch.tensor([[0] * (width - len(row)) + [1] * len(row) for row in rows])
+    return BatchEncoding({"input_ids": input_ids, "attention_mask": attention_mask}).to(model.device)
+
+
+def _pad_token_id(tokenizer):
+    """The tokenizer's pad id, or its EOS id if it has none (0 is a valid pad id)."""
+    return tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+
+
+def _eos_token_ids(tokenizer, model):
+    eos_ids = model.generation_config.eos_token_id
+    if eos_ids is None:
+        eos_ids = tokenizer.eos_token_id
+    if not isinstance(eos_ids, list):
+        eos_ids = [eos_ids]
+    return eos_ids
+
+
+def _note_rows(results):
+    metrics.note(prompt_token=sum(token_count["prompt_token"] for result, token_count in results),
+                 generated_token=sum(token_count["generated_token"] for result, token_count in results))
+
+
+def _split_rows(tokenizer, model, prompt_token_counts, new_tokens):
+    """Decode a batch of generations and count prompt/generated tokens per row."""
+    eos_ids = _eos_token_ids(tokenizer, model)
+    pad_id = _pad_token_id(tokenizer)
+
+    results = []
+    for row in range(new_tokens.shape[0]):
+        tokens = new_tokens[row].tolist()
+        # rows that finished early are padded up to the longest row: after their
+        # EOS token, or right away if a stopping criterion ended them
+        generated = len(tokens)
+        for pos, token in enumerate(tokens):
+            if token in eos_ids:
+                generated = pos + 1
+                break
+            if token == pad_id:
+                generated = pos
+                break
+
+        token_count = {"prompt_token": prompt_token_counts[row], "generated_token": generated}
+        result = tokenizer.decode(tokens[:generated], skip_special_tokens=True)
+        results.append((result, token_count))
+
+    return results
+
+
+
+def get_belief_output(tokenizer, model, msg, schema=None, values=None):
+    """
+    Samples the belief update for one evaluation prompt. If `schema` and
+    `values` are given, the answer is decoded with get_json_outputs instead.
+    """
+    if schema is not None:
+        return get_json_outputs(tokenizer, model, [msg], schema, [values])[0]
+
+    key = _cache_key("belief", model, msg, 512)
+    hit = cache.get(key)
+    if hit is not None:
+        return hit
+
+    text = tokenizer.apply_chat_template(
+        msg, tokenize=False, add_generation_prompt=True
+    )
+
+    inputs = tokenizer(text, return_tensors="pt").to(model.device)
+
+    outputs, _ = _generate(model, None,
+        **inputs,
+        pad_token_id=_pad_token_id(tokenizer),
         max_new_tokens=512,
-        temperature=0.7,
-        top_p=0.9,
+        **SAMPLING,
+        streamer=_streamer(),
     )
 
     new_tokens = outputs[0][inputs["input_ids"].shape[1]:]
     result = tokenizer.decode(new_tokens, skip_special_tokens=True)
+    metrics.note(prompt_token=inputs["input_ids"].shape[1], generated_token=len(new_tokens))
 
+    cache.put(key, result)
     return result
 
 
+def get_belief_outputs(tokenizer, model, msgs, schema=None, values_list=None):
+    """
+    Batched version of get_belief_output.
+
+    Returns a list of results, one per conversation.
+    """
+    if schema is not None:
+        return get_json_outputs(tokenizer, model, msgs, schema, values_list)
+
+    if len(msgs) == 1:
+        return [get_belief_output(tokenizer, model, msgs[0])]
+
+    def generate(missing):
+        inputs = _tokenize_batch(tokenizer, model, [msgs[i] for i in missing])
+        input_len = inputs.input_ids.shape[1]
+
+        outputs, _ = _generate(model, None,
+            **inputs,
+            pad_token_id=_pad_token_id(tokenizer),
+            max_new_tokens=512,
+            **SAMPLING,
+            streamer=_streamer(),
+        )
+
+        results = _split_rows(tokenizer, model, inputs.attention_mask.sum(dim=1).tolist(), outputs[:, input_len:])
+        _note_rows(results)
+        return [result for result, token_count in results]
+
+    keys = [_cache_key("belief", model, msg, 512) for msg in msgs]
+    return _cached_rows(keys, generate)
+
+
+def json_template(schema, values):
+    """
+    Renders the only JSON text `schema` allows when every string field has a
+    known value (beliefs must come back unchanged). Integer fields are left
+    open as (minimum, maximum) slots. Keys are followed by ":" without a
+    space, so a slot's digit directly follows the ":" token.
+
+    :param schema: A JSON schema made of objects, arrays, strings and integers,
+        e.g. belief_json_schema["json_schema"]["schema"].
+    :param values: The string values, nested like the schema, e.g. {"belief": "..."}.
+        Arrays take their length from the values.
+    :return: A list of segments, literal strings and (minimum, maximum) tuples.
+    """
+    segments = []
+
+    def render(schema, value):
+        if schema["type"] == "object":
+            segments.append("{")
+            for i, (key, prop) in enumerate(schema["properties"].items()):
+                if i > 0:
+                    segments.append(", ")
+                segments.append(f"{json.dumps(key)}:")
+                render(prop, value.get(key) if value else None)
+            segments.append("}")
+        elif schema["type"] == "array":
+            segments.append("[")
+            for i, item in enumerate(value):
+                if i > 0:
+                    segments.append(", ")
+                render(schema["items"], item)
+            segments.append("]")
+        elif schema["type"] == "string":
+            segments.append(json.dumps(value))
+        elif schema["type"] == "integer":
+            segments.append((schema.get("minimum", 0), schema.get("maximum", 9)))
+        else:
+            raise ValueError(f"Unsupported schema type: {schema['type']}")
+
+    render(schema, values)
+
+    # merge neighbouring literals
+    merged = []
+    for segment in segments:
+        if merged and isinstance(segment, str) and isinstance(merged[-1], str):
+            merged[-1] += segment
+        else:
+            merged.append(segment)
+    return merged
+
+
+def _token_schedule(tokenizer, prefix, segments, eos_id):
+    """
+    Turns template segments (after the prompt prefix) into the allowed token ids
+    of every decoding step, ending with eos.
+
+    Every segment is tokenized together with the text before it and only the
+    new tokens are kept, so the schedule follows the tokenizer's own word
+    boundaries (e.g. SentencePiece "▁" tokens).
+
+    :return: The schedule, or None if the template cannot be constrained with
+        this tokenizer: an integer value that is more than one token, or text
+        whose tokens change with the text that follows it.
+    """
+    def encode(text):
+        return tokenizer.encode(text, add_special_tokens=False)
+
+    context, context_ids = prefix, encode(prefix)
+    # the values of the last slot; the text after it must tokenize the same for all of them
+    slot_values = [""]
+    schedule = []
+    for segment in segments:
+        if isinstance(segment, str):
+            continuations = []
+            for value in slot_values:
+                start = encode(context + value)
+                ids = encode(context + value + segment)
+                if ids[:len(start)] != start:
+                    return None
+                continuations.append(ids[len(start):])
+            if any(ids != continuations[0] for ids in continuations):
+                return None
+            schedule.extend([token] for token in continuations[0])
+            context += slot_values[0] + segment
+            context_ids = encode(context)
+            slot_values = [""]
+        else:
+            if slot_values != [""]:
+                return None
+            values = [str(number) for number in range(segment[0], segment[1] + 1)]
+            allowed = []
+            for value in values:
+                ids = encode(context + value)
+                if ids[:len(context_ids)] != context_ids or len(ids) != len(context_ids) + 1:
+                    return None
+                allowed.append(ids[-1])
+            schedule.append(allowed)
+            slot_values = values
+    schedule.append([eos_id])
+    return schedule
+
+
+class JSONTemplateProcessor(LogitsProcessor):
+    """
+    Masks the logits so that every row can only produce the next token of
+    its schedule. Rows past their schedule can only produce eos.
+    """
+    def __init__(self, schedules, prompt_len, eos_id):
+        self.schedules = schedules
+        self.prompt_len = prompt_len
+        self.eos_id = eos_id
+
+    def __call__(self, input_ids, scores):
+        step = input_ids.shape[1] - self.prompt_len
+        mask = torch.full_like(scores, float("-inf"))
+        for row, schedule in enumerate(self.schedules):
+            allowed = schedule[step] if step < len(schedule) else [self.eos_id]
+            mask[row, allowed] = 0
+        return scores + mask
+
+
+def get_json_outputs(tokenizer, model, msgs, schema, values_list):
+    """
+    Generates schema-valid JSON answers in one batched call.
+
+    The JSON text up to the first open integer field is appended to the
+    prompt, the remaining literal tokens are forced by JSONTemplateProcessor,
+    and only the integer fields are sampled. Decoding ends with the closing
+    brace, so an answer costs a handful of tokens and always parses. Answers
+    whose template the tokenizer cannot constrain (see _token_schedule) are
+    decoded freely, as with get_belief_outputs.
+
+    :param schema: The JSON schema of the answer (see json_template).
+    :param values_list: The string values of each answer, one per conversation.
+    :return: A list of JSON strings, one per conversation.
+    """
+    eos_id = _eos_token_ids(tokenizer, model)[0]
+
+    def generate(missing):
+        results = {}
+        texts, prefixes, schedules, rows = [], [], [], []
+        for i in missing:
+            segments = json_template(schema, values_list[i])
+            prefix = segments.pop(0) if isinstance(segments[0], str) else ""
+            schedule = _token_schedule(tokenizer, prefix, segments, eos_id)
+            if schedule is None:
+                continue
+            text = tokenizer.apply_chat_template(msgs[i], tokenize=False, add_generation_prompt=True)
+            texts.append(text + prefix)
+            prefixes.append(prefix)
+            schedules.append(schedule)
+            rows.append(i)
+
+        # templates this tokenizer cannot constrain are decoded freely
+        free = [i for i in missing if i not in rows]
+        if free:
+            for i, result in zip(free, get_belief_outputs(tokenizer, model, [msgs[i] for i in free])):
+                results[i] = result
+        if rows:
+            for i, result in zip(rows, _constrained_rows(tokenizer, model, texts, prefixes, schedules, eos_id)):
+                results[i] = result
+        return [results[i] for i in missing]
+
+    keys = [_cache_key("json", model, msg, None, extra=[schema, values]) for msg, values in zip(msgs, values_list)]
+    return _cached_rows(keys, generate)
+
+
+def _constrained_rows(tokenizer, model, texts, prefixes, schedules, eos_id):
+    """One generate call for prompts that end in their JSON prefix, following their schedules."""
+    inputs = _pad_batch(tokenizer, model, texts)
+    input_len = inputs.input_ids.shape[1]
+
+    outputs, _ = _generate(model, None,
+        **inputs,
+        pad_token_id=_pad_token_id(tokenizer),
+        max_new_tokens=max(len(schedule) for schedule in schedules),
+        **SAMPLING,
+        logits_processor=LogitsProcessorList([JSONTemplateProcessor(schedules, input_len, eos_id)]),
+        streamer=_streamer(),
+    )
+    metrics.note(prompt_token=int(inputs.attention_mask.sum()),
+                 generated_token=sum(min(len(schedule) + 1, outputs.shape[1] - input_len) for schedule in schedules))
+
+    results = []
+    for prefix, new_tokens in zip(prefixes, outputs[:, input_len:]):
+        results.append(prefix + tokenizer.decode(new_tokens, skip_special_tokens=True))
+    return results
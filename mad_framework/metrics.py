@@ -0,0 +1,158 @@
+import csv
+import time
+import contextvars
+from contextlib import contextmanager
+
+
+# Counters of the model call in progress. asyncio tasks and asyncio.to_thread
+# copy the context, so the backend libraries can add to them from anywhere
+# inside the call.
+_current = contextvars.ContextVar("mad_metrics_call", default=None)
+
+# functions called with the stats of every finished model call
+_hooks = []
+
+FIELDS = ["site", "backend", "model", "turns", "wall_time", "ttft", "decode_time", "prompt_token",
+          "cached_prompt_token", "generated_token", "tokens_per_sec", "cache_hits", "draft_token", "accepted_token"]
+
+
+def add_hook(hook):
+    """Calls hook(stats) after every model call, see timed."""
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    _hooks.remove(hook)
+
+
+def active():
+    """True inside a measured model call."""
+    return _current.get() is not None
+
+
+def note(**values):
+    """
+    Adds token counts or cache hits to the model call in progress, if any.
+    A `ttft` value (seconds) only lowers the call's time to first token.
+    """
+    stats = _current.get()
+    if stats is None:
+        return
+    for name, value in values.items():
+        if name == "ttft":
+            if stats["ttft"] is None or value < stats["ttft"]:
+                stats["ttft"] = value
+        else:
+            stats[name] += value
+
+
+def first_token():
+    """Marks that the first generated token of the call in progress is ready."""
+    stats = _current.get()
+    if stats is not None:
+        note(ttft=time.perf_counter() - stats["start"])
+
+
+async def timed(site, backend, turns, coro):
+    """
+    Awaits a backend coroutine and measures it.
+
+    :param site: What the call is for, e.g. "respond", "sample" or "eval".
+    :param backend: The backends.Backend that runs the call.
+    :param turns: Number of conversations in the call.
+    :return: (result of coro, stats) where stats has the fields in FIELDS.
+    """
+    stats = {"site": site, "backend": backend.name, "model": backend.model, "turns": turns, "ttft": None,
+             "prompt_token": 0, "cached_prompt_token": 0, "generated_token": 0, "cache_hits": 0,
+             "draft_token": 0, "accepted_token": 0, "start": time.perf_counter()}
+    token = _current.set(stats)
+    try:
+        result = await coro
+    finally:
+        _current.reset(token)
+
+    stats["wall_time"] = time.perf_counter() - stats.pop("start")
+    stats["decode_time"] = stats["wall_time"] - (stats["ttft"] or 0)
+    stats["tokens_per_sec"] = stats["generated_token"] / stats["decode_time"] if stats["decode_time"] > 0 else 0.0
+    for hook in list(_hooks):
+        hook(stats)
+    return result, stats
+
+
+class MetricsRecorder:
+    """
+    Keeps the stats of every model call; use as a hook (add_hook) or with
+    collect(). The calls can be written as CSV or as Prometheus text.
+    """
+    def __init__(self):
+        self.records = []
+
+    def __call__(self, stats):
+        self.records.append(stats)
+
+    def totals(self):
+        """Sums per (site, backend, model)."""
+        totals = {}
+        for stats in self.records:
+            key = (stats["site"], stats["backend"], stats["model"])
+            total = totals.setdefault(key, {"calls": 0, "turns": 0, "wall_time": 0.0, "ttft": 0.0, "ttft_calls": 0,
+                                            "prompt_token": 0, "cached_prompt_token": 0, "generated_token": 0, "cache_hits": 0,
+                                            "draft_token": 0, "accepted_token": 0})
+            total["calls"] += 1
+            for name in ["turns", "wall_time", "prompt_token", "cached_prompt_token", "generated_token", "cache_hits",
+                         "draft_token", "accepted_token"]:
+                total[name] += stats[name]
+            if stats["ttft"] is not None:
+                total["ttft"] += stats["ttft"]
+                total["ttft_calls"] += 1
+        return totals
+
+    def to_csv(self, path):
+        with open(path, "w", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=FIELDS)
+            writer.writeheader()
+            for stats in self.records:
+                writer.writerow({name: stats[name] for name in FIELDS})
+
+    def to_prometheus(self):
+        """The totals in the Prometheus text exposition format."""
+        metrics = [
+            ("mad_model_calls_total", "calls", "Model calls."),
+            ("mad_model_turns_total", "turns", "Conversations answered."),
+            ("mad_model_wall_seconds_total", "wall_time", "Wall time of the model calls."),
+            ("mad_model_ttft_seconds_total", "ttft", "Time to first token, summed over the calls that report it."),
+            ("mad_model_ttft_calls_total", "ttft_calls", "Calls that report a time to first token."),
+            ("mad_model_prompt_tokens_total", "prompt_token", "Prefilled prompt tokens."),
+            ("mad_model_cached_prompt_tokens_total", "cached_prompt_token", "Prompt tokens reused from a key/value cache."),
+            ("mad_model_generated_tokens_total", "generated_token", "Decoded tokens."),
+            ("mad_response_cache_hits_total", "cache_hits", "Responses served from the response cache."),
+            ("mad_model_draft_tokens_total", "draft_token", "Tokens proposed by draft models (assisted decoding)."),
+            ("mad_model_accepted_draft_tokens_total", "accepted_token", "Draft tokens accepted by the model."),
+        ]
+        totals = self.totals()
+        lines = []
+        for metric, field, description in metrics:
+            lines.append(f"# HELP {metric} {description}")
+            lines.append(f"# TYPE {metric} counter")
+            for (site, backend, model), total in totals.items():
+                lines.append(f'{metric}{{site="{site}",backend="{backend}",model="{model}"}} {total[field]}')
+        return "\n".join(lines) + "\n"
+
+    def save(self, path):
+        """Writes the calls as CSV, or the totals as Prometheus text if the path ends in .prom."""
+        if path.endswith(".prom"):
+            with open(path, "w") as file:
+                file.write(self.to_prometheus())
+        else:
+            self.to_csv(path)
+
+
+@contextmanager
+def collect():
+    """Records the stats of the model calls made inside the block."""
+    recorder = MetricsRecorder()
+    add_hook(recorder)
+    try:
+        yield recorder
+    finally:
+        remove_hook(recorder)
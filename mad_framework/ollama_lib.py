@@ -1,5 +1,18 @@
+import os
 import requests
 import json
+from requests.adapters import HTTPAdapter
+from . import cache, metrics
+
+
+OLLAMA_HOST = os.environ.get("OLLAMA_HOST", "http://localhost:11434")
+
+# ---- Pooled session ----
+# one keep-alive connection pool for every call instead of a new connection per request
+session = requests.Session()
+session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=32))
+session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32))
+
 
 def ask_ollama(url,data):
     """
@@ -8,7 +21,7 @@ def ask_ollama(url,data):
     """
     data_json = json.dumps(data)
     try:
-        response = requests.post(url, data=data_json, headers={'Content-Type': 'application/json'})
+        response = session.post(url, data=data_json, headers={'Content-Type': 'application/json'})
 
         if response.status_code == 200:
             response_dict = response.json()
@@ -23,7 +36,16 @@ def ask_ollama(url,data):
 
 def get_output(model,msg,format=None):
 
-    url = 'http://localhost:11434/api/chat'
+    answer, token_count = chat(model, msg, format)
+    return answer
+
+
+def chat(model, msg, format=None, stop=None):
+    """
+    Same as get_output, but also returns the token counts reported by Ollama.
+    stop [list]: strings that end the generation
+    """
+    url = f'{OLLAMA_HOST}/api/chat'
 
     data = {
         "model": model,
@@ -33,10 +55,31 @@ def get_output(model,msg,format=None):
 
     if format:
         data['format'] = format
+    if stop:
+        data['options'] = {"stop": stop}
+
+    key = cache.key(backend="ollama", host=OLLAMA_HOST, **data)
+    hit = cache.get(key)
+    if hit is not None:
+        return tuple(hit)
 
     answer = ask_ollama(url,data)
     try:
+        token_count = {"prompt_token": answer.get("prompt_eval_count", 0), "generated_token": answer.get("eval_count", 0)}
+        metrics.note(**token_count)
+        if "total_duration" in answer and "eval_duration" in answer:
+            # everything before decoding: loading, queueing and prefill (nanoseconds)
+            metrics.note(ttft=(answer["total_duration"] - answer["eval_duration"]) / 1e9)
         answer = answer['message']['content']
-        return answer
+        cache.put(key, [answer, token_count])
+        return answer, token_count
     except:
-        return(answer)
+        return answer, {"prompt_token": 0, "generated_token": 0}
+
+
+def load(model):
+    """
+    Asks the server to load `model` into memory. A request without a prompt
+    only loads the model, so the first chat call does not wait for it.
+    """
+    return ask_ollama(f'{OLLAMA_HOST}/api/generate', {"model": model})
@@ -1,32 +1,207 @@
 import os
+import time
+import random
+import asyncio
+import threading
 import openai
 from dotenv import load_dotenv
+from . import cache, metrics
 
-load_dotenv("./.env")
-openai.api_key = os.environ.get("OPENAI_API_KEY")
 
+# The clients are created on first use, after reading ./.env, so that
+# importing this module does not touch the environment or the network.
+# Both clients honour OPENAI_BASE_URL, so a mock server can stand in for the API.
+# Retries are handled below, with the rate limiter, instead of inside the SDK.
+client = None
+# async client with its own pooled connections, used by backends.OpenAIBackend
+aclient = None
+_setup_lock = threading.Lock()
 
-client = openai.Client()
 
-def get_gpt_output(model, msg, response_format=None):
+def setup():
+    """Reads ./.env and creates the clients and the rate limiter, once."""
+    global client, aclient, rate_limiter
+    with _setup_lock:
+        if aclient is not None:
+            return
+        load_dotenv("./.env")
+        openai.api_key = os.environ.get("OPENAI_API_KEY")
+        if rate_limiter is None:
+            rate_limiter = RateLimiter(_env_int("OPENAI_RPM"), _env_int("OPENAI_TPM"))
+        client = openai.Client(max_retries=0)
+        aclient = openai.AsyncOpenAI(max_retries=0)
 
-    while True:
-        try:
+# errors worth retrying; everything else is raised right away
+RETRY_ERRORS = (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)
+MAX_RETRIES = 8
+BACKOFF_BASE = 1.0   # seconds
+BACKOFF_CAP = 60.0   # seconds
+
+
+class RateLimiter:
+    """
+    Token buckets for requests per minute and tokens per minute. acquire()
+    waits until both budgets allow the request; the token estimate is
+    corrected with the real usage once the response is back.
+    """
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.rpm = requests_per_minute
+        self.tpm = tokens_per_minute
+        self.request_budget = requests_per_minute or 0
+        self.token_budget = tokens_per_minute or 0
+        self.updated = time.monotonic()
+        self._lock = None
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        if self.rpm:
+            self.request_budget = min(self.rpm, self.request_budget + elapsed * self.rpm / 60)
+        if self.tpm:
+            self.token_budget = min(self.tpm, self.token_budget + elapsed * self.tpm / 60)
+
+    async def acquire(self, tokens):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        # one waiter at a time keeps the requests in order
+        async with self._lock:
+            while True:
+                self._refill()
+                wait = 0
+                if self.rpm and self.request_budget < 1:
+                    wait = max(wait, (1 - self.request_budget) * 60 / self.rpm)
+                if self.tpm and self.token_budget < min(tokens, self.tpm):
+                    wait = max(wait, (min(tokens, self.tpm) - self.token_budget) * 60 / self.tpm)
+                if wait == 0:
+                    break
+                await asyncio.sleep(wait)
+            if self.rpm:
+                self.request_budget -= 1
+            if self.tpm:
+                self.token_budget -= tokens
+
+    def settle(self, estimated, used):
+        if self.tpm:
+            self.token_budget += estimated - used
+
+
+def _env_int(name):
+    value = os.environ.get(name)
+    return int(value) if value else None
+
+# created by setup, unless configure_rate_limits was called first
+rate_limiter = None
+
+
+def configure_rate_limits(requests_per_minute=None, tokens_per_minute=None):
+    """
+    Sets the request/token-per-minute budgets shared by every async call.
+    They default to the OPENAI_RPM and OPENAI_TPM environment variables
+    (also read from ./.env).
+    """
+    global rate_limiter
+    rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+
+
+def _backoff(attempt, error):
+    """Seconds to wait before retry number `attempt`: Retry-After if the server sent one, else full jitter."""
+    response = getattr(error, "response", None)
+    if response is not None:
+        retry_after = response.headers.get("retry-after")
+        if retry_after:
+            try:
+                return float(retry_after) + random.uniform(0, 1)
+            except ValueError:
+                pass
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+def _request(model, msg, response_format, stop=None):
+    data = {
+        "model": model,
+        "messages": msg,
+        "temperature": 0.7,
+        "top_p": 0.9,
+        "max_tokens": 2048,
+    }
 
-            data = {
-                "model": model,
-                "messages": msg,
-                "temperature": 0.7,
-                "top_p": 0.9,
-                "max_tokens": 2048,
-            }
+    if (response_format != None):
+        data["response_format"] = response_format
+    if stop:
+        data["stop"] = stop
+    return data
 
-            if (response_format != None):
-                data["response_format"] = response_format
 
+def get_gpt_output(model, msg, response_format=None, stop=None):
+
+    data = _request(model, msg, response_format, stop)
+    key = cache.key(backend="openai", **data)
+    hit = cache.get(key)
+    if hit is not None:
+        return hit[0]
+    setup()
+
+    for attempt in range(MAX_RETRIES + 1):
+        try:
             response = client.chat.completions.create(**data)
 
+            token_count = {"prompt_token": response.usage.prompt_tokens, "generated_token": response.usage.completion_tokens}
+            metrics.note(**token_count)
+            cache.put(key, [response.choices[0].message.content, token_count])
             return response.choices[0].message.content
-        except openai.OpenAIError as e:
-            raise e
-        
\ No newline at end of file
+        except RETRY_ERRORS as e:
+            if attempt == MAX_RETRIES:
+                raise e
+            time.sleep(_backoff(attempt, e))
+
+
+async def aget_gpt_output(model, msg, response_format=None, stop=None):
+    """
+    Async version of get_gpt_output that also returns the token usage.
+    Waits for the rate limiter budget and retries rate limits, timeouts and
+    server errors with jittered exponential backoff.
+    """
+    data = _request(model, msg, response_format, stop)
+    key = cache.key(backend="openai", **data)
+    hit = cache.get(key)
+    if hit is not None:
+        return tuple(hit)
+    setup()
+
+    # rough estimate (4 characters per token) until the real usage is known
+    estimated = sum(len(str(m["content"])) for m in msg) // 4 + data["max_tokens"]
+
+    for attempt in range(MAX_RETRIES + 1):
+        await rate_limiter.acquire(estimated)
+        try:
+            response = await aclient.chat.completions.create(**data)
+        except RETRY_ERRORS as e:
+            rate_limiter.settle(estimated, 0)
+            if attempt == MAX_RETRIES:
+                raise e
+            await asyncio.sleep(_backoff(attempt, e))
+            continue
+
+        rate_limiter.settle(estimated, response.usage.total_tokens)
+        token_count = {"prompt_token": response.usage.prompt_tokens, "generated_token": response.usage.completion_tokens}
+        metrics.note(**token_count)
+        cache.put(key, [response.choices[0].message.content, token_count])
+        return response.choices[0].message.content, token_count
+
+
+async def dispatch(model, msgs, response_format=None, stop=None, max_concurrency=16):
+    """
+    Runs many chat completions concurrently within the rate limits.
+
+    :param msgs: A list of chat histories.
+    :param max_concurrency: Maximum number of requests in flight.
+    :return: A list of (text, token_count), in the order of `msgs`.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def call(msg):
+        async with semaphore:
+            return await aget_gpt_output(model, msg, response_format, stop)
+
+    return await asyncio.gather(*(call(msg) for msg in msgs))
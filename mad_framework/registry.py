@@ -0,0 +1,133 @@
+import gc
+import time
+import threading
+import warnings
+from collections import OrderedDict
+
+
+class ModelRegistry:
+    """
+    Loaded models, kept within a memory budget.
+
+    Models are kept after their last call. When loading a model would exceed
+    `max_bytes`, the least recently used models are freed first, but only
+    models that no live Agent refers to (see acquire/release). If the
+    budget cannot be met that way, a warning is issued and the models stay.
+
+    The footprint of a model is counted over all its devices (CPU memory and
+    GPU memory alike), as reported by the loader.
+    """
+    def __init__(self, max_bytes=None, on_free=None):
+        """
+        :param max_bytes: Memory budget of all resident models in bytes. None is unbounded.
+        :param on_free: Called after a model is freed, e.g. to release cached GPU memory.
+        """
+        self.max_bytes = max_bytes
+        self.on_free = on_free
+        # name -> {"value", "bytes", "loaded", "used"}, least recently used first
+        self._entries = OrderedDict()
+        # name -> number of live users
+        self._refs = {}
+        # footprint of every model loaded so far, to make room before loading it again
+        self._sizes = {}
+        self._lock = threading.RLock()
+
+    def get(self, name, load, size, estimate=None):
+        """
+        Returns the model `name`, loading it with load() if it is not resident.
+
+        :param load: Loads the model, e.g. returns (tokenizer, model).
+        :param size: Footprint in bytes of a value returned by load.
+        :param estimate: Returns the expected footprint in bytes before the first load,
+            or None if it is not known. Only called with a memory budget.
+        """
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                # room is made before loading, for the size of an earlier load or else the estimate
+                needed = self._sizes.get(name)
+                if needed is None and estimate is not None and self.max_bytes is not None:
+                    needed = estimate()
+                self._make_room(needed or 0, warn=False)
+                value = load()
+                entry = {"value": value, "bytes": size(value), "loaded": time.time()}
+                self._entries[name] = entry
+                self._sizes[name] = entry["bytes"]
+                self._make_room(0, keep=name)
+            self._entries.move_to_end(name)
+            entry["used"] = time.time()
+            return entry["value"]
+
+    def acquire(self, name):
+        """Marks `name` as in use, so it is not evicted. The model need not be loaded yet."""
+        with self._lock:
+            self._refs[name] = self._refs.get(name, 0) + 1
+
+    def release(self, name):
+        """Undoes one acquire. The model stays resident until it is evicted or freed."""
+        with self._lock:
+            refs = self._refs.get(name, 0) - 1
+            if refs > 0:
+                self._refs[name] = refs
+            else:
+                self._refs.pop(name, None)
+
+    def free(self, name, force=False):
+        """
+        Frees a resident model now.
+
+        :param force: Also free a model that is still acquired; it is loaded again on its next call.
+        :return: True if the model was resident.
+        """
+        with self._lock:
+            if name not in self._entries:
+                return False
+            if self._refs.get(name) and not force:
+                raise ValueError(f"{name} is still used by {self._refs[name]} agent(s)")
+            self._evict(name)
+            return True
+
+    def clear(self):
+        """Frees every model that is not acquired."""
+        with self._lock:
+            for name in [name for name in self._entries if not self._refs.get(name)]:
+                self._evict(name)
+
+    def resident_bytes(self):
+        with self._lock:
+            return sum(entry["bytes"] for entry in self._entries.values())
+
+    def report(self):
+        """
+        :return: One dict per resident model, least recently used first, with its
+            footprint in bytes, number of users and load / last use times.
+        """
+        with self._lock:
+            return [{"model": name, "bytes": entry["bytes"], "refs": self._refs.get(name, 0),
+                     "loaded": entry["loaded"], "used": entry["used"]}
+                    for name, entry in self._entries.items()]
+
+    def _make_room(self, needed, keep=None, warn=True):
+        if self.max_bytes is None:
+            return
+        total = self.resident_bytes()
+        for name in list(self._entries):
+            if total + needed <= self.max_bytes:
+                return
+            if name == keep or self._refs.get(name):
+                continue
+            total -= self._entries[name]["bytes"]
+            self._evict(name)
+        if warn and total + needed > self.max_bytes:
+            warnings.warn(f"Resident models use {(total + needed) / 1024**2:.0f} MB, over the budget of "
+                          f"{self.max_bytes / 1024**2:.0f} MB, but all of them are in use")
+
+    def _evict(self, name):
+        del self._entries[name]
+        gc.collect()
+        if self.on_free is not None:
+            self.on_free()
+
+
+# models of the Hugging Face backend, see huggingface_lib.load_model
+models = ModelRegistry()
@@ -0,0 +1,131 @@
+import os
+import io
+import json
+
+
+class JSONLSink:
+    """
+    Append-only file of discussion results, one JSON object per line.
+
+    Records are buffered and made durable (flush + fsync) every fsync_every
+    records and on close. Paths ending in ".zst" are zstd-compressed; every
+    flush closes a zstd frame, so an interrupted file still decodes up to
+    the last flush.
+    """
+    def __init__(self, path, fsync_every=16):
+        """
+        :param path: The output file, appended to if it exists.
+        :param fsync_every: Number of records written between two fsyncs.
+        """
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.path = path
+        self.fsync_every = fsync_every
+        self.pending = 0
+        if os.path.exists(path):
+            _drop_partial_tail(path)
+        self._file = open(path, "ab")
+        self._compressor = _zstd().ZstdCompressor() if path.endswith(".zst") else None
+        self._writer = self._compressor.stream_writer(self._file, closefd=False) if self._compressor else self._file
+
+    def write(self, record):
+        """
+        Appends one record.
+
+        :return: True if this write flushed every record so far to disk.
+        """
+        self._writer.write((json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8"))
+        self.pending += 1
+        if self.pending >= self.fsync_every:
+            self.flush()
+            return True
+        return False
+
+    def flush(self):
+        if self._compressor:
+            self._writer.flush(_zstd().FLUSH_FRAME)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.pending = 0
+
+    def close(self):
+        self.flush()
+        if self._compressor:
+            self._writer.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_jsonl(path):
+    """
+    Lazily yields the records of a results file written by JSONLSink. A
+    truncated last line, left by an interrupted job, is skipped.
+    """
+    with open(path, "rb") as file:
+        if path.endswith(".zst"):
+            reader = _zstd().ZstdDecompressor().stream_reader(file, read_across_frames=True)
+            lines = io.TextIOWrapper(reader, encoding="utf-8")
+        else:
+            lines = io.TextIOWrapper(file, encoding="utf-8")
+        for line in lines:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                if line.endswith("\n"):
+                    raise
+                return
+
+
+def load_dataframe(paths, key=None):
+    """
+    Loads the records of one or more results files into a DataFrame.
+
+    :param paths: A path or a list of paths.
+    :param key: Columns identifying a record, e.g. ["run", "question"]. If
+        given, only the last record of each key is kept, since a resumed job
+        may have written some records again.
+    """
+    import pandas as pd
+
+    if isinstance(paths, str):
+        paths = [paths]
+    df = pd.DataFrame([record for path in paths for record in read_jsonl(path)])
+    if key is not None and len(df):
+        df = df.drop_duplicates(subset=key, keep="last").reset_index(drop=True)
+    return df
+
+
+def _drop_partial_tail(path):
+    """Cuts off a record or zstd frame left half-written by an interrupted job, so appends start clean."""
+    with open(path, "rb") as file:
+        data = file.read()
+    if path.endswith(".zst"):
+        end = 0
+        while end < len(data):
+            decompressor = _zstd().ZstdDecompressor().decompressobj()
+            try:
+                decompressor.decompress(data[end:])
+            except _zstd().ZstdError:
+                break
+            if not decompressor.eof:
+                break
+            end = len(data) - len(decompressor.unused_data)
+    else:
+        end = data.rfind(b"\n") + 1
+    if end < len(data):
+        with open(path, "r+b") as file:
+            file.truncate(end)
+
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("Compressed results (.zst) need the zstandard package: pip install zstandard")
+    return zstandard
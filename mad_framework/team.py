@@ -2,12 +2,16 @@ from typing import List, Tuple
 import json
 import re
 from pydantic import BaseModel, Field
-from .const import belief_scale, belief_eval_prompt, belief_json_schema
-from .huggingface_lib import load_model, get_output, get_belief_output
+from .const import belief_scale, belief_eval_prompt, belief_json_schema, belief_list_eval_prompt, belief_list_json_schema, verdict_pattern
+from .backends import get_backend, run
+from .history import MessageHistory
+from .context import ContextPolicy
+from . import metrics
+import weakref
+import warnings
 from copy import deepcopy
-# import ollama
-# from ollama_lib import get_output
-# from openai_lib import get_gpt_output
+from collections import Counter
+import asyncio
 
 
 
@@ -21,20 +25,70 @@ class BeliefList(BaseModel):
 
 
 class Agent:
-    def __init__(self, name:str, persona:str, beliefs:List[Tuple[str, float]], model:str):
+    def __init__(self, name:str, persona:str, beliefs:List[Tuple[str, float]], model:str, kv_cache:bool=False, constrained_eval:bool=True,
+                 stop_patterns:List[str]=None, stop_sequences:List[str]=None, verbose:bool=False, context:ContextPolicy=None,
+                 draft_model:str=None):
         """
         Initializes the Agent with the specified persona, task, and model.
 
         :param name: The name of the agent.
         :param persona: Background information or context for the agent.
         :param task: The goal the agent is tasked with achieving.
-        :param model: The model used by the agent.
+        :param model: The model used by the agent. The backend is picked from the name
+            (see backends.resolve_backend).
+        :param kv_cache: Keep the key/value cache of the agent's conversation between
+            turns (Hugging Face models only), so each turn only prefills the new messages.
+            It is only used when the turn is generated on its own, so not with a simultaneous
+            Team or with several discussions in flight (see run_debates).
+        :param constrained_eval: Decode belief updates of Hugging Face models as JSON that
+            follows the belief schema, sampling only the strengths.
+        :param stop_patterns: Regular expressions that end a response as soon as they match,
+            e.g. const.verdict_stop_pattern. Hugging Face models stop decoding there.
+        :param stop_sequences: Literal strings passed as `stop` to the OpenAI / Ollama APIs.
+        :param verbose: Print the chat history of every turn.
+        :param context: A ContextPolicy that keeps the agent's prompts within a token budget.
+            It holds the agent's rolling summary, so every agent needs its own.
+        :param draft_model: A small model of the same family (e.g. a 0.5B model for a 7B one)
+            that drafts tokens for assisted decoding of the agent's turns (Hugging Face models
+            only). Turns are then decoded one at a time, and their token counts also report
+            draft_token, accepted_token and acceptance_rate. Not used with kv_cache.
         """
         self.name:str = name
         self.persona:str = persona
         self.model:str = model
         self.beliefs:List[Tuple[str, float]] = beliefs
-        self.tokenizer_load, self.model_load = load_model(self.model)
+        # the model itself is loaded on the agent's first call
+        self.backend = get_backend(self.model)
+        self.kv_cache = None
+        if kv_cache:
+            from .huggingface_lib import PrefixCache
+            self.kv_cache = PrefixCache()
+        self.constrained_eval:bool = constrained_eval
+        self.stop_patterns = stop_patterns
+        self.stop_sequences = stop_sequences
+        self.verbose = verbose
+        self.history = MessageHistory()
+        self.context = context
+        self.draft_model = draft_model
+        if draft_model is not None and not self.backend.supports_draft:
+            raise ValueError(f"{self.backend.name} models do not support a draft model")
+        # keeps the agent's models in memory until it is closed or garbage collected
+        self.backend.acquire(draft_model)
+        self._release = weakref.finalize(self, self.backend.release, draft_model)
+
+    def close(self):
+        """Lets the model registry free the agent's models once no other agent uses them."""
+        self._release()
+
+    @property
+    def tokenizer_load(self):
+        """The tokenizer of a Hugging Face model, loaded on first use; None for other backends."""
+        return self.backend.tokenizer_load if hasattr(type(self.backend), "tokenizer_load") else None
+
+    @property
+    def model_load(self):
+        """The Hugging Face model, loaded on first use; None for other backends."""
+        return self.backend.model_load if hasattr(type(self.backend), "model_load") else None
 
     def describe(self):
         """
@@ -54,84 +108,43 @@ class Agent:
         :param message: The input message for the agent.
         :return: The response from the model.
         """
-        belief = self.format_belief_box(self.beliefs)
-
-        system_prompt = f"You are {self.name}. {system_text}"
-        # system_prompt = f"{system_text}\n{belief_scale}\nYou are {self.name}. You will defend your beliefs in the discussion and present arguments to support them." #: {belief}"
-
-        messages = [{"role": "system", "content": system_prompt}]
-
-        curr_agent = self.name
-        # number of rounds finished by the current agent so far:
-        curr_agent_rounds = len(agent_log[curr_agent])
-
-        if '1' in curr_agent:
-            messages.append({"role": "user", "content": task_prompt})
-            # messages.append({"role": "user", "content": f"Your Beliefs: {belief}\n" + task_prompt})
-        # loop to add responses of all agents from previous rounds
-        user_msgs = []
-        for r in range(curr_agent_rounds):
-            for agent in agent_log:
-                if agent == curr_agent:
-                    if len(user_msgs) > 0:
-                        if messages[-1]["role"].lower() == "user":
-                            messages[-1]["content"] = messages[-1]["content"] + "\n" + "\n".join(user_msgs) + "\n\n" + f"###\n\n" + task_prompt
-                            # messages[-1]["content"] = messages[-1]["content"] + "\n" + "\n".join(user_msgs) + "\n\n" + f"###\n\nYour Beliefs: {belief}\n" + task_prompt
-                        else:
-                            messages.append({"role": "user", "content": "\n".join(user_msgs) + f"###\n\n" + task_prompt})
-                            # messages.append({"role": "user", "content": "\n".join(user_msgs) + f"###\n\nYour Beliefs: {belief}\n" + task_prompt})
-                        user_msgs = []
-                    assistant_msg = agent_log[curr_agent][r].lstrip(f"{curr_agent}: ")
-                    messages.append({"role": "assistant", "content": assistant_msg})
-                    continue
-                if agent != curr_agent and len(agent_log[agent]) > r:
-                    user_msgs.append(agent_log[agent][r])
-        if len(user_msgs) > 0:
-            if messages[-1]["role"].lower() == "user":
-                messages[-1]["content"] = messages[-1]["content"] + "\n" + "\n".join(user_msgs)  + "\n\n" + f"###\n\n" + task_prompt
-                # messages[-1]["content"] = messages[-1]["content"] + "\n" + "\n".join(user_msgs)  + "\n\n" + f"###\n\nYour Beliefs: {belief}\n" + task_prompt
-            else:
-                messages.append({"role": "user", "content": "\n".join(user_msgs)})
-        
-        new_user_prompts = []
-        for agent in agent_log.keys():
-            if agent != curr_agent and len(agent_log[agent]) > curr_agent_rounds:
-                new_user_prompts.append(agent_log[agent][curr_agent_rounds])  # Only get new messages
-        # If any agents already went in the current round, add those to the first user prompt along with the task_prompt, else just add task_prompt
-        if len(new_user_prompts) > 0:
-            if messages[-1]["role"].lower() == "assistant" or messages[-1]["role"].lower() == "system":
-                messages.append({"role": "user", "content": "\n".join(new_user_prompts) + "\n\n" + f"###\n\n" + task_prompt})
-                # messages.append({"role": "user", "content": "\n".join(new_user_prompts) + "\n\n" + f"###\n\nYour Beliefs: {belief}\n" + task_prompt})
-            else:
-                messages[-1]["content"] = messages[-1]["content"] + "\n" + "\n".join(new_user_prompts) + "\n" + f"###\n\n" + task_prompt
-                # messages[-1]["content"] = messages[-1]["content"] + "\n" + "\n".join(new_user_prompts) + "\n" + f"###\n\nYour Beliefs: {belief}\n" + task_prompt
-        else:
-            if messages[-1]["role"].lower() == "user":
-                if len(messages) != 2:
-                    messages[-1]["content"] = messages[-1]["content"] + "\n" + f"###\n\n" + task_prompt
-                    # messages[-1]["content"] = messages[-1]["content"] + "\n" + f"###\n\nYour Beliefs: {belief}\n" + task_prompt
-
-        message_log[self.name] = messages 
-        
+        messages = self.build_messages(system_text, task_prompt, agent_log, message_log)
+        return self.generate(messages)
 
-        print(f"agent:{self.name}")
-        print(messages)
-
-        if self.model in ["gpt-4o-mini-2024-07-18"]:        
-            model_respond = get_gpt_output(model=self.model, msg=messages)
+    def build_messages(self, system_text:str, task_prompt:str, agent_log:dict, message_log:dict, simultaneous:bool=False,
+                       simultaneous_rounds:int=0):
+        """
+        Builds the chat history the agent sees for its next turn. The history is
+        kept between turns (see MessageHistory), so only new responses are added.
+        :param simultaneous: Only show the responses of finished rounds (see Team).
+        :param simultaneous_rounds: Number of leading rounds that were spoken simultaneously
+            (1 with Team.shared_first_round), see MessageHistory.build.
+        :return: The list of chat messages to send to the model.
+        """
+        if simultaneous:
+            messages = self.history.build_simultaneous(self.name, system_text, task_prompt, agent_log)
         else:
+            messages = self.history.build(self.name, system_text, task_prompt, agent_log, simultaneous_rounds)
+        if self.context is not None:
+            messages = self.context.fit_messages(self.backend, messages)
+        message_log[self.name] = messages
 
-            # model_respond = ollama.chat(model=self.model, messages=messages)
-            # model_respond = model_respond['message']['content']
-            model_respond, token_count = get_output(tokenizer=self.tokenizer_load, model=self.model_load, msg=messages)
+        if self.verbose:
+            print(f"agent:{self.name}")
+            print(messages)
 
-        # chat_respond = f"{model_respond}"
-        chat_respond = f"{self.name}: {model_respond}"
+        return messages
 
-        return chat_respond, token_count
+    def generate(self, messages:List[dict]):
+        """
+        Runs the agent's model on an already built chat history.
+        :return: The agent's response prefixed with its name, and the token counts.
+        """
+        return respond_batch([self], [messages])[0]
 
     def eval(self, discussion:List[str]):
         curr_beliefs = (self.beliefs).copy()
+        discussion = self.fit_discussion(discussion, belief_eval_prompt)
         text_discussion = "\n".join(discussion)
 
         for i in range(len(self.beliefs)):
@@ -143,17 +156,15 @@ class Agent:
                             {"role": "user", "content": user_prompt}]
 
 
-            if self.model in ["gpt-4o-mini-2024-07-18"]:        
-                response = get_gpt_output(model=self.model, msg=messages, response_format=belief_json_schema)
-            else:
+            values_list = [{"belief": self.beliefs[i][0]}] if self.constrained_eval else None
+            responses, stats = run(metrics.timed("eval", self.backend, 1, self.backend.evaluate([messages], belief_json_schema, values_list)))
+            response = responses[0]
 
-                response = get_belief_output(tokenizer=self.tokenizer_load, model=self.model_load, msg=messages)
-                
-                try:
-                    match = re.search(r"\{.*\}", response, flags=re.DOTALL)
-                    response = match.group(0)
-                except:
-                    print(response)
+            try:
+                match = re.search(r"\{.*\}", response, flags=re.DOTALL)
+                response = match.group(0)
+            except:
+                print(response)
 
             try:
                 updated_belief = json.loads(response)
@@ -169,6 +180,57 @@ class Agent:
 
         return f"{self.name}\n\nStarting Beliefs:\n{curr_beliefs}\n\nUpdated Beliefs:\n{self.beliefs}" 
 
+    def fit_discussion(self, discussion:List[str], prompt:str):
+        """
+        Applies the agent's context policy to the discussion of a belief evaluation prompt.
+        :param prompt: The evaluation prompt template, counted as fixed tokens.
+        """
+        if self.context is None:
+            return discussion
+        fixed_tokens = self.context.count(self.backend, f"{prompt}{self.persona}{self.beliefs}{belief_scale}")
+        return self.context.fit_turns(self.backend, discussion, self.name, fixed_tokens)
+
+    def build_eval_messages(self, discussion:List[str]):
+        """
+        Builds a single prompt that asks for the updated strength of all beliefs at once.
+        :param discussion: The responses of the discussion so far.
+        :return: The list of chat messages to send to the model.
+        """
+        discussion = self.fit_discussion(discussion, belief_list_eval_prompt)
+        text_discussion = "\n".join(discussion)
+        belief_lines = "\n".join(f'- "{belief}" (Current Strength: {strength})' for belief, strength in self.beliefs)
+
+        system_prompt = f"Persona: You are {self.name}. {self.persona}\nCurrent Beliefs: {self.beliefs}"
+        user_prompt = belief_list_eval_prompt.format(belief_scale, text_discussion, belief_lines)
+
+        return [{"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_prompt}]
+
+    def update_beliefs(self, response:str):
+        """
+        Applies a BeliefList response from the joint evaluation prompt.
+        Beliefs are matched by position; if the response cannot be parsed,
+        every strength is set to 0, as in Agent.eval.
+        :param response: The raw model response.
+        :return: A summary of the starting and updated beliefs.
+        """
+        curr_beliefs = (self.beliefs).copy()
+
+        try:
+            match = re.search(r"\{.*\}", response, flags=re.DOTALL)
+            belief_list = BeliefList(**json.loads(match.group(0)))
+            if len(belief_list.beliefs) != len(self.beliefs):
+                raise ValueError(f"expected {len(self.beliefs)} beliefs, got {len(belief_list.beliefs)}")
+            for i, updated_belief in enumerate(belief_list.beliefs):
+                self.beliefs[i] = (self.beliefs[i][0], updated_belief.updated_strength)
+
+        except Exception:
+            print(response)
+            for i in range(len(self.beliefs)):
+                self.beliefs[i] = (self.beliefs[i][0], 0)
+
+        return f"{self.name}\n\nStarting Beliefs:\n{curr_beliefs}\n\nUpdated Beliefs:\n{self.beliefs}"
+
 
     def format_belief_box(self,belief_box):
         """
@@ -191,17 +253,43 @@ class Agent:
 
 
 class Team:
-    def __init__(self, agents, pattern, strategy="efficient"):
+    def __init__(self, agents, pattern, strategy="efficient", eval_mode="per_belief", shared_first_round=False,
+                 consensus=None, consensus_confidence=0, simultaneous=False, verbose=False):
         """
         Initializes the Team with a list of agents and a speaking pattern.
 
         :param agents: A list of Agent objects.
         :param pattern: A list representing the speaking order pattern.
         :param strategy: A list representing strategy. Can be any from [efficient, belief].
+        :param eval_mode: How beliefs are evaluated with the belief strategy. Can be any from
+            [per_belief, joint]. per_belief asks one prompt per belief (Agent.eval), joint scores
+            all beliefs of an agent in one prompt and batches the prompts of all agents together.
+        :param shared_first_round: Run the first round simultaneously: every agent answers the
+            task without seeing the others, from one shared prompt (the system text without the
+            agent's name). Agents on the same model get their answers from a single prefill with
+            one sampled continuation per agent. Later rounds are unchanged.
+        :param consensus: End the discussion early once this fraction of the agents (e.g. 1.0 for
+            all of them) give the same answer in their latest "Answer: ...; Confidence: NN%" line.
+            None always runs every round.
+        :param consensus_confidence: Minimum confidence (in %) every agreeing agent must state
+            for the consensus to end the discussion.
+        :param simultaneous: Every agent answers round r seeing only the rounds before it, so all
+            turns of a round are generated together (batched or as concurrent requests) instead
+            of one after another. Each agent sees the task, then per finished round its own
+            answer and the other agents' answers.
+        :param verbose: Print the round progress of every discussion.
         """
         self.agents = agents
         self.pattern = pattern
         self.strategy = strategy
+        self.eval_mode = eval_mode
+        self.shared_first_round = shared_first_round
+        self.consensus = consensus
+        self.consensus_confidence = consensus_confidence
+        self.simultaneous = simultaneous
+        self.verbose = verbose
+        if simultaneous and any(agent.kv_cache is not None for agent in agents):
+            warnings.warn("kv_cache is not used by a simultaneous Team, its turns are generated in one batch")
 
     def kickoff(self, system_text, task_prompt, rounds=3, eval_rate = 1):
 
@@ -211,56 +299,410 @@ class Team:
         :param topic: The initial topic of discussion.
         :param rounds: Number of discussion rounds.
         """
-        order = generate_custom_order(self.pattern, rounds)
-        discussion = []
-        prompt = task_prompt
-        agent_log = {}
-        message_log = {}
-        for agent in self.agents:
+        debate = self.start(system_text, task_prompt, rounds=rounds, eval_rate=eval_rate)
+        while not debate.done:
+            speakers, messages_list = debate.pending()
+            debate.record(respond_batch(speakers, messages_list))
+
+        return debate.result()
+
+    def start(self, system_text, task_prompt, rounds=3, eval_rate = 1):
+        """
+        Sets up a discussion without generating anything, so that the caller
+        can interleave its turns with other discussions (see run_debates).
+
+        :return: A Debate advanced with Debate.pending / Debate.record.
+        """
+        return Debate(self, system_text, task_prompt, rounds=rounds, eval_rate=eval_rate)
+
+    def evaluate(self, discussion):
+        """
+        Updates the beliefs of every agent based on the discussion so far.
+
+        :param discussion: The responses of the discussion so far.
+        """
+        if self.eval_mode == "joint":
+            eval_batch(self.agents, discussion)
+        else:
+            for agent in self.agents:
+                agent_change = agent.eval(discussion)
+
+    def next_wave(self, order, turn):
+        """
+        Returns the turn indices, starting at `turn`, that can be generated together.
+
+        A turn can join the wave only if its speaker does not see any response
+        produced inside the wave. In the sequential order every speaker sees all
+        earlier turns, so the wave is the single next turn.
+
+        :param order: The speaking order from generate_custom_order.
+        :param turn: Index of the first turn that has not been generated yet.
+        :return: A list of consecutive turn indices.
+        """
+        if self.simultaneous or (self.shared_first_round and turn == 0):
+            # a simultaneous round: every agent speaks once, unaware of the others in the round
+            round_end = (turn // len(self.pattern) + 1) * len(self.pattern)
+            wave, speakers = [], set()
+            while turn + len(wave) < min(round_end, len(order)) and order[turn + len(wave)] not in speakers:
+                speakers.add(order[turn + len(wave)])
+                wave.append(turn + len(wave))
+            return wave
+        return [turn]
+
+
+class Debate:
+    def __init__(self, team, system_text, task_prompt, rounds=3, eval_rate = 1):
+        """
+        Holds the state of one discussion between the agents of a team.
+
+        :param team: The Team whose agents take part in the discussion.
+        :param system_text: The system instructions shared by all agents.
+        :param task_prompt: The task every agent responds to.
+        :param rounds: Number of discussion rounds.
+        :param eval_rate: Number of rounds between belief evaluations.
+        """
+        self.team = team
+        self.system_text = system_text
+        self.prompt = task_prompt
+        self.eval_rate = eval_rate
+        self.order = generate_custom_order(team.pattern, rounds)
+        self.turn = 0
+        self.wave = []
+        # latest (answer, confidence) of every agent, for the consensus check
+        self.verdicts = {}
+        self.stop_reason = None
+        # model call stats per call site, see add_calls
+        self.metrics = {}
+
+        self.discussion = []
+        self.agent_log = {}
+        self.message_log = {}
+        for agent in team.agents:
             # list of responses for each agent:
-            agent_log[agent.name] = []
-            message_log[agent.name] = []
+            self.agent_log[agent.name] = []
+            self.message_log[agent.name] = []
 
-        prev_agent = None
-        last_processed_index = {agent: 0 for agent in agent_log.keys()}
+        self.belief_changes = {}
+        for agent in team.agents:
+            self.belief_changes[agent.name] = {"Initial": deepcopy(agent.beliefs)}
 
-        belief_changes = {}
-        for agent in self.agents:
-            belief_changes[agent.name] = {"Initial": deepcopy(agent.beliefs)}
+        self.discussion_dict = {}
 
-        discussion_dict = {}
-        for turn in range(len(order)):
-            round_num = (turn // len(self.pattern)) + 1
+    @property
+    def done(self):
+        return self.stop_reason is not None or self.turn >= len(self.order)
+
+    def pending(self):
+        """
+        Builds the prompts of the next wave of turns.
+
+        :return: The speaking agents and their chat histories.
+        """
+        self.wave = self.team.next_wave(self.order, self.turn)
+        speakers = [self.team.agents[self.order[t]] for t in self.wave]
+        round_num = (self.turn // len(self.team.pattern)) + 1
+        if self.team.verbose:
             print(f"\n\nRound: {round_num}\n")
-            agent = self.agents[order[turn]]
-            response, token_count = agent.respond(system_text, prompt, agent_log, message_log)
+        if self.team.shared_first_round and self.turn == 0:
+            # one list object for everybody, so respond_batch samples it with a single prefill
+            messages = [{"role": "system", "content": self.system_text}, {"role": "user", "content": self.prompt}]
+            for agent in speakers:
+                self.message_log[agent.name] = messages
+            return speakers, [messages] * len(speakers)
+        simultaneous_rounds = 1 if self.team.shared_first_round else 0
+        messages_list = [agent.build_messages(self.system_text, self.prompt, self.agent_log, self.message_log,
+                                              self.team.simultaneous, simultaneous_rounds)
+                         for agent in speakers]
+        return speakers, messages_list
+
+    def record(self, responses):
+        """
+        Stores the responses to the wave returned by the last pending call.
 
-            agent_log[agent.name].append(response)
-            discussion.append(response)
-            prev_agent = self.agents[order[turn]].name
+        :param responses: A list of (response, token_count), one per turn of the wave.
+        """
+        pattern = self.team.pattern
+        self.add_calls([token_count["call"] for response, token_count in responses if "call" in token_count])
+        for turn, (response, token_count) in zip(self.wave, responses):
+            agent = self.team.agents[self.order[turn]]
+            round_num = (turn // len(pattern)) + 1
+            self.agent_log[agent.name].append(response)
+            self.discussion.append(response)
 
             # --- Build JSON discussion round by round ---
             round_key = f"Round {round_num}"
-            if round_key not in discussion_dict:
-                discussion_dict[round_key] = {}
+            if round_key not in self.discussion_dict:
+                self.discussion_dict[round_key] = {}
 
             clean_response = response.split(':', 1)[1].lstrip()
-            discussion_dict[round_key][agent.name] = {"output": clean_response, "prompt_token": token_count["prompt_token"], "generated_token": token_count["generated_token"]}
+            self.discussion_dict[round_key][agent.name] = {"output": clean_response, "prompt_token": token_count["prompt_token"], "generated_token": token_count["generated_token"]}
+
+            verdict = parse_verdict(response)
+            if verdict is not None:
+                self.verdicts[agent.name] = verdict
 
 
-            if ((turn + 1) % len(self.pattern)) == 0: # at the end of a round clear the agents reponses [0, 1, 2, 3]
-                print(f"\nEnd of round: {turn// len(self.pattern) + 1}")
+            if ((turn + 1) % len(pattern)) == 0 and self.team.verbose: # at the end of a round clear the agents reponses [0, 1, 2, 3]
+                print(f"\nEnd of round: {turn// len(pattern) + 1}")
                 print("\n\n\n")
 
 
-            if self.strategy == "belief":
-                if (((turn + 1) % (len(self.pattern)*eval_rate)) == 0) or (turn + 1 == len(order)):
-                    for agent in self.agents:
-                        agent_change = agent.eval(discussion)
-                        belief_changes[agent.name][f"Round {(turn// len(self.pattern)) + 1}"] = deepcopy(agent.beliefs)
+            if self.team.strategy == "belief":
+                if (((turn + 1) % (len(pattern)*self.eval_rate)) == 0) or (turn + 1 == len(self.order)):
+                    self.evaluate()
+                    for agent in self.team.agents:
+                        self.belief_changes[agent.name][f"Round {(turn// len(pattern)) + 1}"] = deepcopy(agent.beliefs)
+
+        self.turn = self.wave[-1] + 1
+        self.wave = []
+
+        if self.team.consensus is not None:
+            self.check_consensus()
+
+    def check_consensus(self):
+        """
+        Ends the discussion once enough agents agree, confidently enough, and
+        logs why and how many turns were saved under the "Consensus" key.
+        """
+        answer = None
+        if len(self.verdicts) == len(self.team.agents):
+            answer, votes = Counter(a for a, c in self.verdicts.values()).most_common(1)[0]
+            confident = all(c >= self.team.consensus_confidence for a, c in self.verdicts.values() if a == answer)
+            if votes < self.team.consensus * len(self.team.agents) or not confident:
+                answer = None
+
+        if answer is not None and self.turn < len(self.order):
+            self.stop_reason = "consensus"
+            if self.team.strategy == "belief" and self.turn % (len(self.team.pattern) * self.eval_rate) != 0:
+                # the final evaluation would otherwise be skipped
+                self.evaluate()
+                for agent in self.team.agents:
+                    self.belief_changes[agent.name][f"Round {(self.turn - 1) // len(self.team.pattern) + 1}"] = deepcopy(agent.beliefs)
+        elif self.turn >= len(self.order):
+            self.stop_reason = "consensus" if answer is not None else "max_rounds"
+        else:
+            return
+
+        self.discussion_dict["Consensus"] = {
+            "reason": self.stop_reason,
+            "answer": answer,
+            "turns": self.turn,
+            "saved_turns": len(self.order) - self.turn,
+        }
+
+    def evaluate(self):
+        """Runs Team.evaluate and keeps the stats of its model calls."""
+        with metrics.collect() as recorder:
+            self.team.evaluate(self.discussion)
+        self.add_calls(recorder.records)
+
+    def add_calls(self, calls):
+        """
+        Adds model calls to the summary of this discussion. A call that also
+        answered turns of other discussions (see run_debates) adds its wall time
+        and time to first token in full, and the share of its tokens and
+        cache hits that belongs to this discussion's turns.
+
+        :param calls: metrics.timed stats, one per turn or per call.
+        """
+        turns = {}
+        for stats in calls:
+            turns[id(stats)] = (stats, turns.get(id(stats), (stats, 0))[1] + 1)
+        for stats, count in turns.values():
+            share = 1 if stats["site"] == "eval" else count / stats["turns"]
+            summary = self.metrics.setdefault(stats["site"], {"calls": 0, "turns": 0, "wall_time": 0.0, "ttft": 0.0, "prompt_token": 0,
+                                                              "cached_prompt_token": 0, "generated_token": 0, "cache_hits": 0,
+                                                              "draft_token": 0, "accepted_token": 0})
+            summary["calls"] += 1
+            summary["turns"] += stats["turns"] if stats["site"] == "eval" else count
+            summary["wall_time"] += stats["wall_time"]
+            summary["ttft"] += stats["ttft"] or 0
+            for name in ["prompt_token", "cached_prompt_token", "generated_token", "cache_hits", "draft_token", "accepted_token"]:
+                summary[name] += stats[name] * share
+
+    def result(self):
+        if self.metrics:
+            for summary in self.metrics.values():
+                decode_time = summary["wall_time"] - summary["ttft"]
+                summary["tokens_per_sec"] = summary["generated_token"] / decode_time if decode_time > 0 else 0.0
+                if summary["draft_token"]:
+                    summary["acceptance_rate"] = summary["accepted_token"] / summary["draft_token"]
+            self.discussion_dict["Metrics"] = self.metrics
+        return self.discussion_dict, self.belief_changes
+
+
+def run_debates(debates, on_finish, max_in_flight=8):
+    """
+    Runs many discussions at once. The next wave of every active discussion
+    is gathered into a single respond_batch call, so turns of different
+    discussions that use the same model share one generate call.
+
+    :param debates: An iterable of (key, Debate). It is consumed lazily, so
+        a new discussion is only set up when a slot frees up.
+    :param on_finish: Called as on_finish(key, (discussion_dict, belief_changes))
+        as soon as a discussion has finished.
+    :param max_in_flight: Maximum number of discussions kept active at once.
+    """
+    debates = iter(debates)
+    active = []
+    exhausted = False
+    while True:
+        while not exhausted and len(active) < max_in_flight:
+            try:
+                key, debate = next(debates)
+            except StopIteration:
+                exhausted = True
+                break
+            if debate.done:
+                on_finish(key, debate.result())
+            else:
+                active.append((key, debate))
+
+        if not active:
+            break
+
+        speakers, messages_list, sizes = [], [], []
+        for key, debate in active:
+            debate_speakers, debate_messages = debate.pending()
+            speakers.extend(debate_speakers)
+            messages_list.extend(debate_messages)
+            sizes.append(len(debate_speakers))
+
+        responses = respond_batch(speakers, messages_list)
+
+        still_active = []
+        offset = 0
+        for (key, debate), size in zip(active, sizes):
+            debate.record(responses[offset:offset + size])
+            offset += size
+            if debate.done:
+                on_finish(key, debate.result())
+            else:
+                still_active.append((key, debate))
+        active = still_active
+
+
+def eval_batch(agents, discussion):
+    """
+    Jointly evaluates the beliefs of several agents. Every agent scores all of
+    its beliefs in one prompt, and the prompts of agents that share a backend
+    are sent together (one batched generate call for Hugging Face models).
+
+    :param agents: The agents whose beliefs are updated.
+    :param discussion: The responses of the discussion so far.
+    :return: A list with the summary of each agent's belief change.
+    """
+    agents = [agent for agent in agents if agent.beliefs]
+    messages_list = [agent.build_eval_messages(discussion) for agent in agents]
+    responses = run(_eval_groups(agents, messages_list))
+    return [agent.update_beliefs(response) for agent, response in zip(agents, responses)]
+
+
+async def _eval_groups(agents, messages_list):
+    responses = [None] * len(agents)
+    groups = {}
+    for idx, agent in enumerate(agents):
+        groups.setdefault(id(agent.backend), []).append(idx)
+
+    async def evaluate(indices):
+        backend = agents[indices[0]].backend
+        values_list = None
+        if all(agents[idx].constrained_eval for idx in indices):
+            values_list = [{"beliefs": [{"belief": belief} for belief, strength in agents[idx].beliefs]} for idx in indices]
+        outputs, stats = await metrics.timed("eval", backend, len(indices),
+                                             backend.evaluate([messages_list[idx] for idx in indices], belief_list_json_schema, values_list))
+        for idx, response in zip(indices, outputs):
+            responses[idx] = response
+
+    await asyncio.gather(*(evaluate(indices) for indices in groups.values()))
+    return responses
+
+
+def respond_batch(agents, messages_list):
+    """
+    Generates the responses for several independent turns.
+
+    Turns are grouped by backend: turns of agents that share a Hugging Face
+    model are sent through one batched generate call, Ollama and OpenAI turns
+    are sent as concurrent requests. All groups run at the same time.
+    Turns that pass the very same messages list object are answered with
+    Backend.sample, i.e. one prefill and one sampled continuation per turn.
+
+    :param agents: The speaking agents, one per turn.
+    :param messages_list: The chat history of each turn, from Agent.build_messages.
+    :return: A list of (response, token_count), in the order of `agents`. Every
+        token_count also holds the metrics.timed stats of its model call under "call".
+    """
+    return run(arespond_batch(agents, messages_list))
+
+
+async def arespond_batch(agents, messages_list):
+    """Async version of respond_batch."""
+    results = [None] * len(agents)
+    groups = {}
+    for idx, agent in enumerate(agents):
+        stop = (tuple(agent.stop_patterns or ()), tuple(agent.stop_sequences or ()))
+        groups.setdefault((id(agent.backend), stop, agent.draft_model), []).append(idx)
+
+    def call_kwargs(agent):
+        kwargs = {"stop_patterns": agent.stop_patterns, "stop_sequences": agent.stop_sequences}
+        if agent.draft_model is not None:
+            kwargs["draft_model"] = agent.draft_model
+        return kwargs
+
+    async def respond(indices):
+        backend = agents[indices[0]].backend
+        caches = [agents[idx].kv_cache for idx in indices]
+        if len(indices) > 1 and any(kv_cache is not None for kv_cache in caches):
+            warnings.warn("kv_cache is only used for a turn generated on its own, not in a batch of turns")
+        outputs, stats = await metrics.timed("respond", backend, len(indices),
+                                             backend.respond([messages_list[idx] for idx in indices], caches, **call_kwargs(agents[indices[0]])))
+        for idx, (model_respond, token_count) in zip(indices, outputs):
+            results[idx] = (f"{agents[idx].name}: {model_respond}", dict(token_count, call=stats))
+
+    async def sample(groups):
+        # groups of turns that share one chat history, all of the same size,
+        # e.g. the shared first rounds of several discussions
+        backend = agents[groups[0][0]].backend
+        outputs, stats = await metrics.timed("sample", backend, sum(len(indices) for indices in groups),
+                                             backend.sample_batch([messages_list[indices[0]] for indices in groups],
+                                                                  len(groups[0]), **call_kwargs(agents[groups[0][0]])))
+        for indices, samples in zip(groups, outputs):
+            for idx, (model_respond, token_count) in zip(indices, samples):
+                results[idx] = (f"{agents[idx].name}: {model_respond}", dict(token_count, call=stats))
+
+    tasks = []
+    for indices in groups.values():
+        shared = {}
+        for idx in indices:
+            shared.setdefault(id(messages_list[idx]), []).append(idx)
+        singles = [same[0] for same in shared.values() if len(same) == 1]
+        if singles:
+            tasks.append(respond(singles))
+        by_size = {}
+        for same in shared.values():
+            if len(same) > 1:
+                by_size.setdefault(len(same), []).append(same)
+        tasks.extend(sample(same_size) for same_size in by_size.values())
+
+    await asyncio.gather(*tasks)
+    return results
+
+
+def parse_verdict(response):
+    """
+    Finds the last "Answer: X; Confidence: NN%" line of a response.
+
+    :return: (answer, confidence) with the answer reduced to its first word in
+        lower case (e.g. "b", "yes"), or None if there is no verdict.
+    """
+    matches = re.findall(verdict_pattern, response)
+    if not matches:
+        return None
+    answer, confidence = matches[-1]
+    word = re.search(r"\w+", answer)
+    return (word.group(0).lower() if word else answer.strip().lower()), float(confidence)
 
-        return discussion_dict, belief_changes
-    
 
 def generate_custom_order(pattern, repetitions):
     """